@@ -10,28 +10,49 @@ import subprocess
 import sys
 import argparse
 import fnmatch
+import heapq
+import itertools
+import logging
 import netifaces
 import jinja2
 import json
+import threading
+from machinic_tangle import scanner
+
+logger = logging.getLogger(__name__)
 
 # modified from associative.py in machinic-core
 
 
-def scan_loop(iface, template=None, template_vars=None, patterns=None, rate=5):
+def scan_loop(
+    iface,
+    template=None,
+    template_vars=None,
+    patterns=None,
+    rate=5,
+    provision_ifaces=None,
+):
     if patterns is None:
-        patterns = "*"
+        patterns = ["*"]
+    if not provision_ifaces:
+        provision_ifaces = [iface]
+
+    provisioner = Provisioner(provision_ifaces)
+    provisioner.subscribe(lambda event: print(json.dumps(event)))
 
-    while True:
-        essids = scan(iface)
+    def scanned(results):
+        essids = [bss.ssid for bss in results if bss.ssid]
         for pattern in patterns:
             for match_ssid in fnmatch.filter(essids, pattern):
                 payload = (
                     jinja2.Environment().from_string(template).render(template_vars)
                 )
-                print("{} {}".format(match_ssid, pattern))
-                print("preparing to associate...")
-                associate(iface, match_ssid, payload)
-        time.sleep(rate)
+                provisioner.offer(match_ssid, payload)
+
+    # results of the iface scanner, shared with anything
+    # else in this process scanning iface
+    scanner.scanner(iface, interval=rate).subscribe(scanned)
+    provisioner.join()
 
 
 def scan(scan_iface):
@@ -40,43 +61,230 @@ def scan(scan_iface):
     found_essids = []
 
     for iface in wifi_ifaces:
-        found = []
         print("{} scanning...".format(iface))
-        found = subprocess.check_output(["sudo", "iwlist", iface, "scan"])
-        found = [
-            ssid.split('"')[1] for ssid in str(found).split("\\n") if "ESSID" in ssid
-        ]
+        found = [bss.ssid for bss in scanner.run_scan(iface) if bss.ssid]
 
         print("{} found ssids: {}".format(iface, found))
         found_essids.extend(found)
     return found_essids
 
 
-def associate(iface, essid, payload, delay=5, retries=None):
-    # Send on association
+class Provisioner(object):
+    # provisions devices found by scans, one worker thread
+    # per wireless interface taking ssids from a shared
+    # queue, so devices are provisioned in parallel across
+    # interfaces. An ssid queued, in flight or finished
+    # within the last forget seconds is not queued again
+    #
+    # a failed attempt is queued again after a backoff that
+    # doubles each retry up to max_backoff, the worker moves
+    # on to other devices meanwhile and any interface may
+    # make the next attempt
+    #
+    # subscribers are called on the worker threads with an
+    # event dict for each step: queued, started, retry,
+    # provisioned and failed
+    def __init__(
+        self,
+        ifaces,
+        provision=None,
+        retries=5,
+        backoff=5,
+        max_backoff=60,
+        forget=300,
+    ):
+        if provision is None:
+            provision = connect_and_send
+        self.provision = provision
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.forget = forget
+        self.condition = threading.Condition()
+        # (ready at, sequence, ssid, payload, attempt)
+        self.waiting = []
+        self.sequence = itertools.count()
+        # ssids queued or in flight
+        self.pending = set()
+        # ssid : (monotonic time finished, provisioned)
+        self.finished = {}
+        self.subscribers = []
+        self.stopped = False
+        self.workers = {}
+        for iface in ifaces:
+            self.add_interface(iface)
+
+    def add_interface(self, iface):
+        with self.condition:
+            if iface in self.workers:
+                return
+            worker = threading.Thread(target=self.work, args=(iface,), daemon=True)
+            self.workers[iface] = worker
+        worker.start()
+
+    def remove_interface(self, iface):
+        # the worker of iface stops taking ssids, an attempt
+        # in flight is finished first
+        with self.condition:
+            self.workers.pop(iface, None)
+            self.condition.notify_all()
+
+    def subscribe(self, callback):
+        with self.condition:
+            if callback not in self.subscribers:
+                self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.condition:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def emit(self, event, ssid, **fields):
+        fields.update({"event": event, "ssid": ssid, "time": time.time()})
+        logger.info("%s %s", event, ssid)
+        with self.condition:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(fields)
+            except Exception as ex:
+                logger.warning("provisioning subscriber failed: %s", ex)
+
+    def offer(self, ssid, payload):
+        # queue ssid unless it is already being handled,
+        # returns True if it was queued
+        now = time.monotonic()
+        with self.condition:
+            if ssid in self.pending:
+                return False
+            finished = self.finished.get(ssid)
+            if finished is not None and now - finished[0] < self.forget:
+                return False
+            self.finished.pop(ssid, None)
+            self.pending.add(ssid)
+            heapq.heappush(self.waiting, (now, next(self.sequence), ssid, payload, 0))
+            self.condition.notify()
+        self.emit("queued", ssid)
+        return True
+
+    def status(self):
+        with self.condition:
+            return {
+                "queued": len(self.waiting),
+                "in_flight": len(self.pending) - len(self.waiting),
+                "provisioned": sum(1 for _, ok in self.finished.values() if ok),
+                "failed": sum(1 for _, ok in self.finished.values() if not ok),
+            }
+
+    def take(self, iface):
+        # next ssid ready for an attempt, None once stopped
+        # or the worker of iface has been removed
+        with self.condition:
+            while (
+                not self.stopped
+                and self.workers.get(iface) is threading.current_thread()
+            ):
+                now = time.monotonic()
+                if self.waiting and self.waiting[0][0] <= now:
+                    return heapq.heappop(self.waiting)[2:]
+                timeout = None
+                if self.waiting:
+                    timeout = self.waiting[0][0] - now
+                self.condition.wait(timeout)
+            return None
+
+    def work(self, iface):
+        while True:
+            item = self.take(iface)
+            if item is None:
+                return
+            ssid, payload, attempt = item
+            self.emit("started", ssid, iface=iface, attempt=attempt)
+            try:
+                self.provision(iface, ssid, payload)
+            except Exception as ex:
+                if attempt < self.retries:
+                    delay = min(self.max_backoff, self.backoff * 2**attempt)
+                    with self.condition:
+                        heapq.heappush(
+                            self.waiting,
+                            (
+                                time.monotonic() + delay,
+                                next(self.sequence),
+                                ssid,
+                                payload,
+                                attempt + 1,
+                            ),
+                        )
+                        self.condition.notify()
+                    self.emit(
+                        "retry",
+                        ssid,
+                        iface=iface,
+                        attempt=attempt,
+                        error=str(ex),
+                        delay=delay,
+                    )
+                else:
+                    self.finish(ssid, False)
+                    self.emit(
+                        "failed", ssid, iface=iface, attempt=attempt, error=str(ex)
+                    )
+                continue
+            self.finish(ssid, True)
+            self.emit("provisioned", ssid, iface=iface, attempt=attempt)
+
+    def finish(self, ssid, provisioned):
+        with self.condition:
+            self.pending.discard(ssid)
+            self.finished[ssid] = (time.monotonic(), provisioned)
+            # finished entries past forget are not needed
+            # to dedupe, drop them so the dict stays small
+            for done, (finished_at, _) in list(self.finished.items()):
+                if time.monotonic() - finished_at >= self.forget:
+                    del self.finished[done]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def join(self):
+        for worker in list(self.workers.values()):
+            worker.join()
+
+
+def connect_and_send(iface, essid, payload, post_send_delay=0):
+    # one attempt, raises if it fails
 
     # currently nmcli works much better than iwconfig/dhclient
     # however it is not as portable as iwconfig/dhclient, so
     # worth improving more general / portable approaches
     #
     # see commented code block at below
-
-    try:
-        print(
-            subprocess.check_output(
-                "nmcli dev wifi connect {}".format(essid).split(" ")
-            )
+    print(
+        subprocess.check_output(
+            ["nmcli", "dev", "wifi", "connect", essid, "ifname", iface]
         )
-        send(iface, payload)
-    except Exception as ex:
-        print(ex)
-        # early code would continuously retry without a retries kwarg
-        # if an ssid is not found it led to endless loop of calling associate
-        if retries is not None and retries > 0:
-            print("retry: {}".format(retries))
-            retries -= 1
-            time.sleep(delay)
-            associate(iface, essid, payload, retries=retries)
+    )
+    send(iface, payload, post_send_delay)
+
+
+def associate(iface, essid, payload, delay=5, retries=None):
+    # Send on association, retried up to retries times
+    # delay seconds apart. Returns True if the payload
+    # was sent
+    attempts = 1 + (retries or 0)
+    for attempt in range(attempts):
+        try:
+            connect_and_send(iface, essid, payload, post_send_delay=5)
+            return True
+        except Exception as ex:
+            print(ex)
+            if attempt + 1 < attempts:
+                print("retry: {}".format(attempts - attempt - 1))
+                time.sleep(delay)
+    return False
 
     # # print("diassociating {} before associating".format(iface))
     # # subprocess.check_output(['sudo','iwconfig',iface,'ap','00:00:00:00:00:00'])
@@ -145,8 +353,23 @@ def main():
         default=[],
         help="template vars (key value key value)",
     )
+    parser.add_argument(
+        "--patterns", nargs="+", default=["*"], help="ssid patterns to provision"
+    )
+    parser.add_argument(
+        "--provision-interfaces",
+        nargs="+",
+        default=[],
+        help="wireless ifaces provisioning in parallel, defaults to interface",
+    )
 
     args = parser.parse_args()
     template_vars = dict(zip(args.template_vars[:-1:2], args.template_vars[1::2]))
     print(template_vars)
-    scan_loop(args.interface, args.template, template_vars)
+    scan_loop(
+        args.interface,
+        args.template,
+        template_vars,
+        patterns=args.patterns,
+        provision_ifaces=args.provision_interfaces,
+    )
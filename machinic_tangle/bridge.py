@@ -5,13 +5,61 @@
 #
 # Copyright (c) 2018, Galen Curwen-McAdams
 
+import collections
+import logging
 import os
 import sys
-import subprocess
-import pathlib
+import time
+import threading
+import zlib
 import redis
 import paho.mqtt.client as mosquitto
-from textx.metamodel import metamodel_from_file
+from machinic_tangle import calls
+from machinic_tangle import intake
+from machinic_tangle import journal
+from machinic_tangle import metrics
+from machinic_tangle import pathling
+from machinic_tangle import routes
+from machinic_tangle import writer
+
+logger = logging.getLogger(__name__)
+
+
+class LoopGuard(object):
+    # remembers writes the bridge made to channels that
+    # routes listen on, for ttl seconds, with the number of
+    # routing hops that led to them. When the write comes
+    # back in it is routed one hop further and dropped once
+    # max_hops is reached, so chains such as mqtt -> db ->
+    # mqtt work while cycles stop
+    #
+    # only messages routed by this process are seen, with
+    # several workers a cycle can pass between them without
+    # limit, so bridges with workers warn about such routes
+    def __init__(self, max_hops=8, ttl=5, size=10000):
+        self.max_hops = max_hops
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # (side, channel, payload) : (expires, hops)
+        self.emitted = collections.OrderedDict()
+
+    def emit(self, side, channel, payload, hops):
+        with self.lock:
+            if len(self.emitted) >= self.size:
+                self.emitted.popitem(last=False)
+            self.emitted[(side, channel, payload)] = (time.monotonic() + self.ttl, hops)
+
+    def hops(self, side, channel, payload):
+        # hops that led to this message, 0 if the bridge
+        # did not write it
+        if not self.emitted:
+            return 0
+        with self.lock:
+            emitted = self.emitted.pop((side, channel, payload), None)
+        if emitted is None or emitted[0] < time.monotonic():
+            return 0
+        return emitted[1]
 
 
 class Bridge(object):
@@ -23,102 +71,410 @@ class Bridge(object):
         broker_port,
         env_vars=None,
         allow_shell_calls=False,
+        routes_resync=60,
+        flush_size=256,
+        flush_latency=0.002,
+        shard=None,
+        share_group=None,
+        route_db=True,
+        env_refresh=1,
+        call_workers=4,
+        call_limit=2,
+        call_queue=16,
+        call_overflow="drop",
+        call_timeout=30,
+        metrics_interval=10,
+        metrics_port=None,
+        route_cache=True,
+        journal_dir=None,
+        journal_segment_size=64 * 1024 * 1024,
+        journal_sync=0.05,
+        intake_size=10000,
+        intake_overflow="block",
     ):
         self.routing_ling = "pathling"
         self.routes_key = "machinic:routes:{}:{}".format(db_host, db_port)
         self.env_vars = env_vars
+        # env_vars values as strings, refreshed at most every
+        # env_refresh seconds instead of on every message
+        self.env = {}
+        self.env_refresh = env_refresh
+        self.env_refreshed = None
         self.allow_shell_calls = allow_shell_calls
-        self.pathling_model_file = pathlib.Path(
-            pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling.tx")
+        self.metrics = metrics.Metrics()
+        # shell call destinations run on a bounded pool
+        self.calls = None
+        if self.allow_shell_calls:
+            self.calls = calls.CallPool(
+                workers=call_workers,
+                route_limit=call_limit,
+                queue_depth=call_queue,
+                overflow=call_overflow,
+                timeout=call_timeout,
+                metrics=self.metrics,
+            )
+            self.metrics.gauge("calls_queued", self.calls.queued)
+            self.metrics.gauge("calls_dropped", lambda: self.calls.dropped)
+            self.metrics.gauge("calls_coalesced", lambda: self.calls.coalesced)
+            self.metrics.gauge("calls_timed_out", lambda: self.calls.timeouts)
+        # parsed routes, keyed by route hash. Routes parsed
+        # before, by any process, are read from the route cache
+        self.routes = routes.RouteTable(
+            pathling.parse, pathling.default_cache() if route_cache else None
+        )
+        self.db_settings = {"host": db_host, "port": db_port}
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.flush_size = flush_size
+        self.flush_latency = flush_latency
+        self.intake_size = intake_size
+        self.intake_overflow = intake_overflow
+        # (index, count) when topics are split across worker
+        # processes, only topics hashing to index are routed
+        self.shard = shard
+        # mqtt topic filters subscribed to, derived from the
+        # route sources and prefixed with $share/share_group/
+        # when the broker splits messages between workers
+        self.share_group = share_group
+        # whether db channels and keys are subscribed to, of
+        # several workers only one should route db sources
+        self.route_db = route_db
+        self.mqtt_subscribed = set()
+        self.broker_client = None
+        self.binary_r = redis.StrictRedis(**self.db_settings)
+        self.redis_conn = redis.StrictRedis(**self.db_settings, decode_responses=True)
+        # route edits arrive as keyspace events on the routes
+        # hash, requires notify-keyspace-events KEA. A full
+        # resync every routes_resync seconds covers missed events
+        self.routes_resync = routes_resync
+        self.keyspace_prefix = "__keyspace@{}__:".format(
+            self.redis_conn.connection_pool.connection_kwargs.get("db", 0)
+        )
+        self.routes_channel = self.keyspace_prefix + self.routes_key
+        # db channels and keyspace channels of routes with
+        # db sources, on the same connection as route events
+        self.db_subscribed = set()
+        self.loops = LoopGuard()
+        # routed messages and failed db writes, failed
+        # writes are replayed once the db answers again
+        self.journal = None
+        if journal_dir:
+            self.journal = journal.Journal(
+                journal_dir,
+                segment_size=journal_segment_size,
+                sync_interval=journal_sync,
+            )
+            self.metrics.gauge("journal_pending", lambda: len(self.journal.pending))
+        self.metrics.gauge("routes", lambda: len(self.routes.routes))
+        self.metrics.gauge("routes_invalid", lambda: len(self.routes.invalid))
+        # snapshot to a db hash every metrics_interval seconds
+        # and prometheus text on localhost:metrics_port
+        self.metrics_key = "machinic:metrics:bridge:{}:{}".format(db_host, db_port)
+        if self.shard is not None:
+            self.metrics_key += ":{}".format(self.shard[0])
+        if metrics_interval:
+            self.metrics.publish(self.redis_conn, self.metrics_key, metrics_interval)
+        if metrics_port:
+            self.metrics.serve(metrics_port)
+        self.start()
+
+    def start(self):
+        # received messages wait in a bounded queue for the
+        # routing thread instead of being routed by the
+        # thread that received them
+        self.intake = intake.IntakeQueue(self.intake_size, self.intake_overflow)
+        self.metrics.gauge("intake_queued", lambda: len(self.intake))
+        self.metrics.gauge("intake_dropped", lambda: self.intake.dropped)
+        self.metrics.gauge("intake_coalesced", lambda: self.intake.coalesced)
+        self.intake_thread = threading.Thread(target=self.route_intake, daemon=True)
+        self.intake_thread.start()
+        # destination writes are pipelined in batches
+        self.writer = writer.WriteBatcher(
+            self.redis_conn,
+            flush_size=self.flush_size,
+            flush_latency=self.flush_latency,
+            metrics=self.metrics,
+            journal=self.journal,
+        )
+        self.metrics.gauge("writer_queued", lambda: len(self.writer.ops))
+        self.routes_subscription = self.redis_conn.pubsub(
+            ignore_subscribe_messages=True
         )
-        self.pathling_metamodel = metamodel_from_file(self.pathling_model_file)
-        db_settings = {"host": db_host, "port": db_port}
-        self.binary_r = redis.StrictRedis(**db_settings)
-        self.redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
+        # subscribe before the initial sync so no edit is missed
+        self.routes_subscription.subscribe(self.routes_channel)
+        self.sync_routes()
+        self.routes_thread = threading.Thread(target=self.watch_routes, daemon=True)
+        self.routes_thread.start()
 
         self.broker_client = mosquitto.Client()
         self.broker_client.on_message = self.on_message
-        sub_topics = "#"
-        self.broker_client.connect(broker_host, broker_port, 60)
-        self.broker_client.subscribe(sub_topics, 0)
+        self.broker_client.on_connect = self.on_connect
+        self.broker_client.connect(self.broker_host, self.broker_port, 60)
         self.broker_client.loop_start()
 
-    def on_message(self, mosq, obj, msg):
-        self.routing(msg.topic, msg.payload)
+    def on_connect(self, client, userdata, flags, rc):
+        # subscriptions do not survive a reconnect
+        self.mqtt_subscribed = set()
+        self.update_mqtt_subscriptions()
+
+    def mqtt_filters(self):
+        filters = routes.minimal_filters(self.routes.sources())
+        if self.share_group:
+            filters = {"$share/{}/{}".format(self.share_group, f) for f in filters}
+        return filters
 
-    def routing(self, channel, message):
-        routes = self.redis_conn.hgetall(self.routes_key)
-        substitutions = {}
+    def update_mqtt_subscriptions(self):
+        # subscribe to topics routes can fire for instead
+        # of #, following route changes
+        if self.broker_client is None:
+            return
+        wanted = self.mqtt_filters()
+        subscribe = wanted - self.mqtt_subscribed
+        unsubscribe = self.mqtt_subscribed - wanted
         try:
-            substitutions.update(self.env_vars())
+            if subscribe:
+                self.broker_client.subscribe([(topic, 0) for topic in subscribe])
+            if unsubscribe:
+                self.broker_client.unsubscribe(list(unsubscribe))
         except Exception as ex:
-            pass
-        message = message.decode()
-        substitutions["$message"] = message
-        substitutions["$channel"] = channel
-        for route_hash, route in routes.items():
+            # raised in on_connect it would stop paho's network loop
+            logger.warning("mqtt subscriptions not updated: %s", ex)
+            return
+        self.mqtt_subscribed = wanted
+
+    def on_message(self, mosq, obj, msg):
+        if self.owns(msg.topic):
+            self.intake.put(msg.topic, msg.payload)
+
+    def route_intake(self):
+        while True:
+            channel, message, db = self.intake.get()
+            try:
+                self.routing(channel, message, db=db)
+            except Exception as ex:
+                logger.warning("routing %s failed: %s", channel, ex)
+
+    def db_message(self, channel, message):
+        # a message on a db channel or a keyspace event for
+        # a db key, routed from the db to routes with db sources
+        if channel.startswith(self.keyspace_prefix):
+            # only sets are routed, with the value set. Other
+            # events such as hset, del and expired carry no
+            # value, so hash writes never come back in
+            if message != "set":
+                return
+            channel = channel[len(self.keyspace_prefix) :]
+            message = self.redis_conn.get(channel)
+            if message is None:
+                return
+        self.intake.put(channel, message, True)
+
+    def db_subscriptions(self):
+        # (subscribe, unsubscribe) channels needed for the
+        # current db sources
+        wanted = set()
+        if self.route_db:
+            for source in self.routes.db_sources:
+                wanted.add(source)
+                wanted.add(self.keyspace_prefix + source)
+        subscribe = wanted - self.db_subscribed
+        unsubscribe = self.db_subscribed - wanted
+        self.db_subscribed = wanted
+        return subscribe, unsubscribe
+
+    def update_db_subscriptions(self):
+        subscribe, unsubscribe = self.db_subscriptions()
+        if subscribe:
+            self.routes_subscription.subscribe(*subscribe)
+        if unsubscribe:
+            self.routes_subscription.unsubscribe(*unsubscribe)
+
+    def owns(self, channel):
+        # a topic always hashes to the same worker so
+        # messages on a topic are routed in order
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return zlib.crc32(channel.encode()) % count == index
+
+    def routes_changed(self):
+        self.metrics.forget_routes(self.routes.routes)
+        self.check_cycles()
+
+    def check_cycles(self):
+        # the loop guard cannot stop cycles between workers
+        if self.shard is None and self.share_group is None and self.route_db:
+            return
+        looping = self.routes.cycles()
+        if looping:
+            logger.warning(
+                "routes can loop between workers without limit: %s",
+                ", ".join(sorted(route.route for route in looping)),
+            )
+
+    def sync_routes(self):
+        if self.routes.sync(self.redis_conn.hgetall(self.routes_key)):
+            self.routes_changed()
+        self.update_db_subscriptions()
+        self.update_mqtt_subscriptions()
+
+    def reload_routes(self):
+        # keyspace events do not include the hash field, so
+        # compare hash fields and only fetch routes not known
+        hashes = set(self.redis_conn.hkeys(self.routes_key))
+        known = self.routes.known()
+        added = [hashed for hashed in hashes if hashed not in known]
+        fetched = {}
+        if added:
+            fetched = dict(zip(added, self.redis_conn.hmget(self.routes_key, added)))
+            # deleted between hkeys and hmget
+            fetched = {k: v for k, v in fetched.items() if v is not None}
+        if self.routes.update(fetched, known - hashes):
+            self.routes_changed()
+        self.update_db_subscriptions()
+        self.update_mqtt_subscriptions()
+
+    def watch_routes(self):
+        next_resync = time.monotonic() + self.routes_resync
+        while True:
             try:
-                path = self.pathling_metamodel.model_from_str(route)
-                print(path.munge)
+                timeout = max(0, next_resync - time.monotonic())
+                event = self.routes_subscription.get_message(timeout=timeout)
+                reload = False
+                # drain queued events so a burst of edits
+                # only causes a single reload
+                drained = 0
+                while event is not None and drained < 1000:
+                    if event["channel"] == self.routes_channel:
+                        reload = True
+                    elif event["type"] == "message":
+                        self.db_message(event["channel"], event["data"])
+                    drained += 1
+                    event = self.routes_subscription.get_message(timeout=0)
+                if reload:
+                    self.reload_routes()
+                if time.monotonic() >= next_resync:
+                    self.sync_routes()
+                    next_resync = time.monotonic() + self.routes_resync
+            except Exception as ex:
+                logger.warning("route reload failed: %s", ex)
+                time.sleep(1)
                 try:
-                    # try to do substitutions
-                    message = path.munge.template
-                    for k, v in substitutions.items():
-                        message = message.replace(str(k), str(v))
-                        print(message)
-                except Exception as ex:
-                    print(ex)
-                if path.source == channel:
-                    if path.send_as == "->":
-                        # publish
-                        self.redis_conn.publish(path.destination, message)
-                    elif path.send_as == ">>":
-                        # set key
-                        if isinstance(path.destination, str):
-                            self.redis_conn.set(path.destination, message)
-                        else:
-                            self.redis_conn.hmset(
-                                path.destination.name, {path.destination.field: message}
-                            )
-                    elif path.send_as == "--":
-                        if self.allow_shell_calls:
-                            # strip trailing spaces that may cause subprocess call problems
-                            path.destination.call = path.destination.call.strip(" ")
-                            path.destination.args = [
-                                arg.strip(" ") for arg in path.destination.args
-                            ]
-                            print("sub dict: ", substitutions)
-                            print(
-                                "shell call (pre-sub):",
-                                path.destination.call,
-                                path.destination.args,
-                            )
-                            # substitutions for shell call and args
-                            for k, v in substitutions.items():
-                                path.destination.call = path.destination.call.replace(
-                                    str(k), str(v)
-                                )
-                                for i, shell_param in enumerate(path.destination.args):
-                                    path.destination.args[i] = shell_param.replace(
-                                        str(k), str(v)
-                                    )
-                            print(
-                                "shell call (post-sub):",
-                                path.destination.call,
-                                path.destination.args,
-                            )
-
-                            if "NonblockingCall" in str(path.destination):
-                                subprocess.Popen(
-                                    [path.destination.call, *path.destination.args]
-                                )
-                            elif "BlockingCall" in str(path.destination):
-                                subprocess.Call(
-                                    [path.destination.call, *path.destination.args]
-                                )
-                        else:
-                            print("routing does not allow shell calls")
-                            print(path.destination.call, path.destination.args)
+                    # resubscribe and resync after a dropped connection
+                    self.db_subscribed = set()
+                    self.routes_subscription.subscribe(self.routes_channel)
+                    self.sync_routes()
+                except Exception:
+                    pass
+
+    def refresh_env_vars(self):
+        self.env_refreshed = time.monotonic()
+        try:
+            env = {str(k): str(v) for k, v in self.env_vars().items()}
+        except Exception:
+            env = {}
+        if env != self.env:
+            self.env = env
+
+    def outputs(self, channel, message, db=False):
+        # yield (route, output) for each route that fires,
+        # output is the message to write or the shell call
+        # with args. db selects routes with db sources
+        if (
+            self.env_refreshed is None
+            or time.monotonic() - self.env_refreshed >= self.env_refresh
+        ):
+            self.refresh_env_vars()
+        env = self.env
+        if isinstance(message, bytes):
+            message = message.decode()
+        if db:
+            matched = self.routes.match_db(channel)
+        else:
+            matched = self.routes.match(channel)
+        self.metrics.count("messages", "matched" if matched else "missed")
+        # parsed once, on the first conditional route
+        number = unparsed = object()
+        for route in matched:
+            if route.expression is not None:
+                if number is unparsed:
+                    number = routes.payload_number(message)
+                if number is None or not routes.predicate(*route.expression)(number):
+                    self.metrics.count("conditions_failed")
+                    continue
+            self.metrics.route_hit(route)
+            started = time.perf_counter()
+            try:
+                output = self.render(route, message, channel, env)
             except Exception as ex:
-                print(ex)
-                pass
+                logger.warning("route %s failed: %s", route.route, ex)
+                continue
+            finally:
+                self.metrics.observe("render", time.perf_counter() - started)
+            if output is not None:
+                yield route, output
+
+    def routing(self, channel, message, db=False):
+        if isinstance(message, bytes):
+            message = message.decode()
+        hops = self.loops.hops("db" if db else "mqtt", channel, message)
+        if hops >= self.loops.max_hops:
+            self.metrics.count("loops_dropped")
+            return
+        fired = []
+        for route, output in self.outputs(channel, message, db=db):
+            fired.append(route.route_hash)
+            try:
+                # guard before sending so the write cannot
+                # come back before it is remembered
+                self.guard(route, output, hops)
+                self.send(route, output)
+            except Exception as ex:
+                logger.warning("route %s failed: %s", route.route, ex)
+        if self.journal is not None:
+            self.journal.message("db" if db else "mqtt", channel, message, fired)
+
+    def guard(self, route, output, hops):
+        # remember writes that routes will pick up again
+        if route.kind == "mqtt":
+            if self.routes.match(route.destination):
+                self.loops.emit("mqtt", route.destination, output, hops + 1)
+        elif route.kind in ("publish", "set"):
+            if route.destination in self.routes.db_sources:
+                self.loops.emit("db", route.destination, output, hops + 1)
+
+    def render(self, route, message, channel, env):
+        if route.kind in ("nonblocking", "blocking"):
+            if not self.allow_shell_calls:
+                logger.info(
+                    "routing does not allow shell calls: %s %s",
+                    route.destination,
+                    route.args,
+                )
+                return None
+            # substitutions for shell call and args
+            call = [
+                routes.render_template(tokens, message, channel, env)
+                for tokens in route.compiled
+            ]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("shell call %s: %s", route.route, call)
+            return call
+        elif route.kind is None:
+            return None
+        elif route.compiled:
+            # do substitutions
+            return routes.render_template(route.compiled[0], message, channel, env)
+        return message
+
+    def send(self, route, output):
+        if route.kind == "publish":
+            self.writer.publish(route.destination, output)
+        elif route.kind == "mqtt":
+            self.broker_client.publish(route.destination, output)
+        elif route.kind == "set":
+            self.writer.set(route.destination, output)
+        elif route.kind == "hash":
+            self.writer.hset(route.destination, route.field, output)
+        elif route.kind in ("nonblocking", "blocking"):
+            self.calls.submit(route, output)
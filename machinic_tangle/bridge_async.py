@@ -0,0 +1,300 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import asyncio
+import logging
+import time
+import redis.asyncio
+import paho.mqtt.client as mosquitto
+from machinic_tangle import bridge
+from machinic_tangle import writer
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBridge(bridge.Bridge):
+    # runs mqtt intake, routing and db output as asyncio
+    # tasks connected by bounded queues instead of routing
+    # inside paho's network thread
+    #
+    # intake reads the mqtt socket from the event loop and
+    # stops reading while the intake queue is full, db
+    # writes are pipelined from the output queue while the
+    # router keeps matching, batched by flush_size and
+    # flush_latency and merged as WriteBatcher does. Shell
+    # calls run on the bridge's CallPool without blocking
+    # either
+    def __init__(self, *args, queue_size=1024, **kwargs):
+        self.queue_size = queue_size
+        super(AsyncBridge, self).__init__(*args, **kwargs)
+
+    def start(self):
+        # everything is started from run()
+        pass
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.db = redis.asyncio.StrictRedis(**self.db_settings, decode_responses=True)
+        self.intake = asyncio.Queue(maxsize=self.queue_size)
+        # puts waiting for room in the intake
+        self.waiting_puts = set()
+        self.output = asyncio.Queue(maxsize=self.queue_size)
+        self.reading = False
+        # held while writing so journaled writes are
+        # replayed before newer ones
+        self.write_lock = asyncio.Lock()
+        self.metrics.gauge("intake_queued", self.intake.qsize)
+        self.metrics.gauge("output_queued", self.output.qsize)
+
+        self.routes_subscription = self.db.pubsub(ignore_subscribe_messages=True)
+        # subscribe before the initial sync so no edit is missed
+        await self.routes_subscription.subscribe(self.routes_channel)
+        await self.sync_routes_async()
+        tasks = [
+            self.watch_routes_async(),
+            self.route_messages(),
+            self.write_outputs(),
+            self.broker_misc(),
+        ]
+        if self.journal is not None:
+            tasks.append(self.replay_writes())
+        self.connect_broker()
+        await asyncio.gather(*tasks)
+
+    def connect_broker(self):
+        self.broker_client = mosquitto.Client()
+        self.broker_client.on_message = self.on_message
+        self.broker_client.on_connect = self.on_connect
+        self.broker_client.on_socket_open = self.on_socket_open
+        self.broker_client.on_socket_close = self.on_socket_close
+        self.broker_client.on_socket_register_write = self.on_socket_register_write
+        self.broker_client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.broker_client.connect(self.broker_host, self.broker_port, 60)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        self.resume_reading()
+
+    def on_socket_close(self, client, userdata, sock):
+        self.pause_reading()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def pause_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.sock)
+            self.reading = False
+
+    def resume_reading(self):
+        if not self.reading:
+            self.loop.add_reader(self.sock, self.broker_client.loop_read)
+            self.reading = True
+
+    def on_message(self, mosq, obj, msg):
+        # called from loop_read in the event loop, paho
+        # cannot wait so the queue is bounded by no longer
+        # reading the socket until the router catches up
+        if not self.owns(msg.topic):
+            return
+        try:
+            self.intake.put_nowait((msg.topic, msg.payload, False))
+        except asyncio.QueueFull:
+            # messages paho already read when the queue
+            # filled wait for room in arrival order
+            put = self.loop.create_task(
+                self.intake.put((msg.topic, msg.payload, False))
+            )
+            self.waiting_puts.add(put)
+            put.add_done_callback(self.waiting_puts.discard)
+        if self.intake.full():
+            self.pause_reading()
+
+    async def broker_misc(self):
+        while True:
+            if self.broker_client.loop_misc() != mosquitto.MQTT_ERR_SUCCESS:
+                try:
+                    self.broker_client.reconnect()
+                except Exception as ex:
+                    logger.warning("broker reconnect failed: %s", ex)
+            await asyncio.sleep(1)
+
+    async def route_messages(self):
+        while True:
+            channel, message, db = await self.intake.get()
+            if (
+                not self.reading
+                and not self.waiting_puts
+                and self.intake.qsize() <= self.queue_size // 2
+            ):
+                self.resume_reading()
+            try:
+                await self.routing_async(channel, message, db)
+            except Exception as ex:
+                logger.warning("routing %s failed: %s", channel, ex)
+
+    async def routing_async(self, channel, message, db):
+        if isinstance(message, bytes):
+            message = message.decode()
+        hops = self.loops.hops("db" if db else "mqtt", channel, message)
+        if hops >= self.loops.max_hops:
+            self.metrics.count("loops_dropped")
+            return
+        fired = []
+        for route, output in self.outputs(channel, message, db=db):
+            fired.append(route.route_hash)
+            self.guard(route, output, hops)
+            if route.kind in ("nonblocking", "blocking"):
+                # the pool never blocks, it queues or drops
+                self.calls.submit(route, output)
+            elif route.kind == "mqtt":
+                self.broker_client.publish(route.destination, output)
+            else:
+                await self.output.put((route, output))
+        if self.journal is not None:
+            self.journal.message("db" if db else "mqtt", channel, message, fired)
+
+    async def take_outputs(self):
+        # a batch of outputs, once flush_size are waiting or
+        # flush_latency seconds after the first arrived
+        ops = [await self.output.get()]
+        deadline = self.loop.time() + self.flush_latency
+        while len(ops) < self.flush_size:
+            try:
+                ops.append(self.output.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                ops.append(await asyncio.wait_for(self.output.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return ops
+
+    async def write_outputs(self):
+        while True:
+            ops = await self.take_outputs()
+            ops, merged = writer.merge_sets(
+                [
+                    (route.kind, route.destination, route.field, output)
+                    for route, output in ops
+                ]
+            )
+            if merged:
+                self.metrics.count("writes_merged", value=merged)
+            async with self.write_lock:
+                if self.journal is not None and self.journal.pending:
+                    self.journal.failed(ops)
+                    continue
+                pipe = self.db.pipeline(transaction=False)
+                writer.queue_ops(pipe, ops)
+                started = time.perf_counter()
+                try:
+                    await pipe.execute()
+                    written = len(ops) - merged
+                except Exception as ex:
+                    logger.warning("db write failed: %s", ex)
+                    self.metrics.count("write_errors")
+                    if self.journal is not None:
+                        self.journal.failed(ops)
+                    written = 0
+                self.metrics.observe("redis_write", time.perf_counter() - started)
+                self.metrics.count("writes", value=written)
+
+    async def replay_writes(self):
+        # journaled failures oldest first once the db answers
+        while True:
+            await asyncio.sleep(1)
+            if not self.journal.pending:
+                continue
+            try:
+                await self.db.ping()
+                async with self.write_lock:
+                    for record_id, ops in self.journal.pending_writes():
+                        pipe = self.db.pipeline(transaction=False)
+                        writer.queue_ops(pipe, ops)
+                        await pipe.execute()
+                        self.journal.replayed([record_id])
+                        self.metrics.count("writes_replayed", value=len(ops))
+            except Exception as ex:
+                logger.debug("db writes not replayed yet: %s", ex)
+
+    async def sync_routes_async(self):
+        if self.routes.sync(await self.db.hgetall(self.routes_key)):
+            self.routes_changed()
+        await self.update_db_subscriptions_async()
+        self.update_mqtt_subscriptions()
+
+    async def update_db_subscriptions_async(self):
+        subscribe, unsubscribe = self.db_subscriptions()
+        if subscribe:
+            await self.routes_subscription.subscribe(*subscribe)
+        if unsubscribe:
+            await self.routes_subscription.unsubscribe(*unsubscribe)
+
+    async def db_message_async(self, channel, message):
+        if channel.startswith(self.keyspace_prefix):
+            # only sets are routed, as in db_message
+            if message != "set":
+                return
+            channel = channel[len(self.keyspace_prefix) :]
+            message = await self.db.get(channel)
+            if message is None:
+                return
+        await self.intake.put((channel, message, True))
+
+    async def reload_routes_async(self):
+        hashes = set(await self.db.hkeys(self.routes_key))
+        known = self.routes.known()
+        added = [hashed for hashed in hashes if hashed not in known]
+        fetched = {}
+        if added:
+            fetched = dict(zip(added, await self.db.hmget(self.routes_key, added)))
+            fetched = {k: v for k, v in fetched.items() if v is not None}
+        if self.routes.update(fetched, known - hashes):
+            self.routes_changed()
+        await self.update_db_subscriptions_async()
+        self.update_mqtt_subscriptions()
+
+    async def watch_routes_async(self):
+        subscription = self.routes_subscription
+        next_resync = self.loop.time() + self.routes_resync
+        while True:
+            try:
+                timeout = max(0, next_resync - self.loop.time())
+                event = await subscription.get_message(timeout=timeout)
+                reload = False
+                drained = 0
+                while event is not None and drained < 1000:
+                    if event["channel"] == self.routes_channel:
+                        reload = True
+                    elif event["type"] == "message":
+                        await self.db_message_async(event["channel"], event["data"])
+                    drained += 1
+                    event = await subscription.get_message(timeout=0)
+                if reload:
+                    await self.reload_routes_async()
+                if self.loop.time() >= next_resync:
+                    await self.sync_routes_async()
+                    next_resync = self.loop.time() + self.routes_resync
+            except Exception as ex:
+                logger.warning("route reload failed: %s", ex)
+                await asyncio.sleep(1)
+                try:
+                    self.db_subscribed = set()
+                    await subscription.subscribe(self.routes_channel)
+                    await self.sync_routes_async()
+                except Exception:
+                    pass
@@ -0,0 +1,253 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from machinic_tangle import bridge
+from machinic_tangle import routes
+from machinic_tangle import writer
+
+# route shapes from pathling_spec.txt, {n} is the route
+# number so every route has its own source and destination
+shapes = {
+    "publish": "/bench/{n} -> bench{n}",
+    "munge": '/bench/{n} ["$channel:$message"] -> bench{n}',
+    "hash": '/bench/{n} ["$channel"] >> "bench:{n}"::"field"',
+    "conditional": "(/bench/{n} > 1) -> bench{n}",
+    "mqtt": '/bench/{n} ["$message"] -> /bench/out/{n}',
+    "wildcard": "/bench/{n}/+ -> bench{n}",
+}
+
+
+class FakePipeline(object):
+    def __init__(self, fake):
+        self.fake = fake
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def publish(self, channel, message):
+        self.ops.append(("publish", channel, message))
+
+    def set(self, key, value):
+        self.ops.append(("set", key, value))
+
+    def hmset(self, name, mapping):
+        self.ops.append(("hash", name, mapping))
+
+    def hset(self, name, field, value):
+        self.ops.append(("hash", name, {field: value}))
+
+    def execute(self):
+        self.fake.execute(self.ops)
+        ops = self.ops
+        self.ops = []
+        return [True] * len(ops)
+
+
+class FakeRedis(object):
+    # keeps keys and hashes in dicts and counts publishes,
+    # enough of the client for the write batcher
+    def __init__(self):
+        self.keys = {}
+        self.hashes = {}
+        self.published = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def execute(self, ops):
+        for kind, key, value in ops:
+            if kind == "publish":
+                self.published += 1
+            elif kind == "set":
+                self.keys[key] = value
+            elif kind == "hash":
+                self.hashes.setdefault(key, {}).update(value)
+
+
+class FakeMqtt(object):
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+
+class BenchBridge(bridge.Bridge):
+    # a bridge wired to in-process fakes, routes are
+    # loaded directly instead of from the db
+    def __init__(self, routes_table, **kwargs):
+        self.bench_routes = routes_table
+        kwargs.setdefault("metrics_interval", 0)
+        kwargs.setdefault("route_cache", False)
+        super(BenchBridge, self).__init__("bench", 0, "bench", 0, **kwargs)
+
+    def start(self):
+        self.redis_conn = FakeRedis()
+        self.writer = writer.WriteBatcher(
+            self.redis_conn,
+            flush_size=self.flush_size,
+            flush_latency=self.flush_latency,
+            metrics=self.metrics,
+        )
+        self.broker_client = FakeMqtt()
+        self.routes.sync(self.bench_routes)
+
+
+def route_table(shape, size):
+    table = {}
+    for n in range(size):
+        route = shapes[shape].format(n=n)
+        table[routes.route_hash(route)] = route
+    return table
+
+
+def message_stream(shape, size, count, miss_ratio=0.1, seed=0):
+    # (topic, payload) pairs, miss_ratio of them on topics
+    # no route listens on, payloads alternate around the
+    # conditional threshold
+    rand = random.Random(seed)
+    stream = []
+    for i in range(count):
+        if rand.random() < miss_ratio:
+            topic = "/unrouted/{}".format(rand.randrange(size))
+        elif shape == "wildcard":
+            topic = "/bench/{}/{}".format(rand.randrange(size), i % 16)
+        else:
+            topic = "/bench/{}".format(rand.randrange(size))
+        stream.append((topic, str(i % 4).encode()))
+    return stream
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(shape, size, count, alloc_sample=1000, flush_latency=0.002):
+    table = route_table(shape, size)
+    compile_started = time.perf_counter()
+    bench = BenchBridge(table, flush_latency=flush_latency)
+    compiled = time.perf_counter() - compile_started
+    stream = message_stream(shape, size, count)
+
+    # warm the match cache and predicates
+    for topic, payload in stream[: min(len(stream), 1000)]:
+        bench.routing(topic, payload)
+    bench.writer.flush()
+
+    latencies = []
+    clock = time.perf_counter
+    started = clock()
+    for topic, payload in stream:
+        before = clock()
+        bench.routing(topic, payload)
+        latencies.append(clock() - before)
+    elapsed = clock() - started
+    bench.writer.flush()
+
+    # bytes allocated while routing a message, measured
+    # separately since tracing slows everything down
+    sample = stream[:alloc_sample]
+    tracemalloc.start()
+    allocated = 0
+    blocks = 0
+    for topic, payload in sample:
+        snapshot_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        blocks_before = sys.getallocatedblocks()
+        bench.routing(topic, payload)
+        allocated += tracemalloc.get_traced_memory()[1] - snapshot_before
+        blocks += sys.getallocatedblocks() - blocks_before
+    tracemalloc.stop()
+    bench.writer.flush()
+
+    latencies.sort()
+    return {
+        "shape": shape,
+        "routes": size,
+        "messages": count,
+        "compile_seconds": round(compiled, 4),
+        "messages_per_second": round(count / elapsed) if elapsed else 0,
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 2),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 2),
+        "alloc_bytes_per_message": round(allocated / max(1, len(sample)), 1),
+        "retained_blocks_per_message": round(blocks / max(1, len(sample)), 2),
+        "db_writes": bench.redis_conn.published
+        + len(bench.redis_conn.keys)
+        + sum(len(fields) for fields in bench.redis_conn.hashes.values()),
+        "mqtt_writes": bench.broker_client.published,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="benchmark bridge routing against synthetic route tables, offline"
+    )
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=sorted(shapes),
+        default=["publish", "munge", "hash", "conditional"],
+        help="route shapes to benchmark",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[10, 100, 1000, 10000],
+        help="route table sizes",
+    )
+    parser.add_argument(
+        "--messages", type=int, default=20000, help="messages routed per run"
+    )
+    parser.add_argument(
+        "--alloc-sample",
+        type=int,
+        default=1000,
+        help="messages routed with allocation tracing",
+    )
+    parser.add_argument("--json", action="store_true", help="print json lines")
+    args = parser.parse_args(argv)
+
+    columns = (
+        ("shape", "shape"),
+        ("routes", "routes"),
+        ("messages_per_second", "msgs/s"),
+        ("p50_us", "p50 us"),
+        ("p99_us", "p99 us"),
+        ("alloc_bytes_per_message", "alloc B/msg"),
+        ("retained_blocks_per_message", "blocks/msg"),
+    )
+    if not args.json:
+        print(" ".join("{:>12}".format(header) for _, header in columns))
+    for shape in args.shapes:
+        for size in args.sizes:
+            result = run(shape, size, args.messages, alloc_sample=args.alloc_sample)
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print(
+                    " ".join("{:>12}".format(result[column]) for column, _ in columns),
+                    flush=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
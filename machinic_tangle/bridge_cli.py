@@ -5,13 +5,30 @@
 # Copyright (c) 2018, Galen Curwen-McAdams
 
 import argparse
+import logging
+import multiprocessing
+import os
 import redis
+import paho.mqtt.client as mosquitto
 from machinic_tangle import bridge
+from machinic_tangle import journal
+from machinic_tangle import logs
+from machinic_tangle import writer
 import time
 
+logger = logging.getLogger(__name__)
+
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["run", "replay"],
+        default="run",
+        help="route live messages, or replay the messages in --journal"
+        " as fast as possible for load testing",
+    )
     parser.add_argument("--db-host", default="127.0.0.1", help="db host ip")
     parser.add_argument("--db-port", type=int, default=6379, help="db port")
     parser.add_argument("--broker-host", default="127.0.0.1", help="broker host ip")
@@ -24,8 +41,216 @@ def main():
         action="store_true",
         help="basic DB_* and BROKER_* env_vars",
     )
-    parser.add_argument("--verbose", action="store_true", help="")
+    parser.add_argument(
+        "--resync-interval",
+        type=float,
+        default=60,
+        help="seconds between full route resyncs, edits are applied as they happen",
+    )
+    parser.add_argument(
+        "--flush-size",
+        type=int,
+        default=256,
+        help="write batched db operations once this many are waiting",
+    )
+    parser.add_argument(
+        "--flush-latency",
+        type=float,
+        default=2,
+        help="milliseconds a batched db operation may wait before being written",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="route on a bounded intake thread or as asyncio tasks",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1024,
+        help="bound of the queues between asyncio engine tasks",
+    )
+    parser.add_argument(
+        "--intake-size",
+        type=int,
+        default=10000,
+        help="received messages waiting to be routed by the thread engine"
+        " before --intake-overflow applies",
+    )
+    parser.add_argument(
+        "--intake-overflow",
+        choices=["block", "drop-oldest", "coalesce"],
+        default="block",
+        help="when the intake is full wait, drop the oldest message, or keep"
+        " only the latest message waiting on each topic",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="bridge processes, topics are split between them by a stable hash"
+        " and db channels are routed by the first. Route cycles between"
+        " workers are only warned about, the loop guard is per worker",
+    )
+    parser.add_argument(
+        "--shared-subscription",
+        metavar="GROUP",
+        default=None,
+        help="split topics between workers with $share/GROUP/ broker subscriptions,"
+        " messages on a topic may then be routed out of order",
+    )
+    parser.add_argument(
+        "--call-workers", type=int, default=4, help="threads running shell calls"
+    )
+    parser.add_argument(
+        "--call-limit",
+        type=int,
+        default=2,
+        help="shell calls a route may run at once, blocking calls run one at a time",
+    )
+    parser.add_argument(
+        "--call-queue",
+        type=int,
+        default=16,
+        help="shell calls a route may have waiting",
+    )
+    parser.add_argument(
+        "--call-overflow",
+        choices=["drop", "coalesce"],
+        default="drop",
+        help="when a route's call queue is full drop the new call"
+        " or coalesce by dropping the oldest waiting call",
+    )
+    parser.add_argument(
+        "--call-timeout",
+        type=float,
+        default=30,
+        help="seconds before a shell call is killed",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10,
+        help="seconds between metrics snapshots written to"
+        " machinic:metrics:bridge:{db host}:{db port}, 0 disables",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve prometheus text metrics on localhost:port/metrics,"
+        " workers use consecutive ports",
+    )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help="directory of a journal of routed messages and failed db writes,"
+        " failed writes are replayed when the db answers again",
+    )
+    parser.add_argument(
+        "--journal-segment-size",
+        type=int,
+        default=64,
+        help="megabytes per journal segment file",
+    )
+    parser.add_argument(
+        "--journal-sync",
+        type=float,
+        default=50,
+        help="milliseconds between journal syncs to disk",
+    )
+    parser.add_argument(
+        "--no-route-cache",
+        action="store_true",
+        help="always parse routes instead of reading parses cached on disk",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="log debug messages such as shell calls"
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=int,
+        default=1,
+        help="with --verbose keep one of every N debug messages",
+    )
     args = parser.parse_args()
+
+    if args.mode == "replay":
+        if not args.journal:
+            parser.error("replay requires --journal")
+        replay(args)
+    elif args.workers > 1:
+        workers = [
+            multiprocessing.Process(
+                target=start_bridge, args=(args, worker), daemon=True
+            )
+            for worker in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                worker.terminate()
+    else:
+        start_bridge(args)
+
+
+class ReplayBridge(bridge.Bridge):
+    # a bridge that only sends, nothing is subscribed to so
+    # live messages are left to the running bridge. Routes
+    # are read once instead of followed
+    def start(self):
+        self.writer = writer.WriteBatcher(
+            self.redis_conn,
+            flush_size=self.flush_size,
+            flush_latency=self.flush_latency,
+            metrics=self.metrics,
+        )
+        self.routes.sync(self.redis_conn.hgetall(self.routes_key))
+        self.broker_client = mosquitto.Client()
+        self.broker_client.connect(self.broker_host, self.broker_port, 60)
+        self.broker_client.loop_start()
+
+    def update_mqtt_subscriptions(self):
+        pass
+
+    def update_db_subscriptions(self):
+        pass
+
+
+def replay(args):
+    # route journaled messages through a bridge, outputs
+    # are written as if the messages had just arrived
+    logs.setup(verbose=args.verbose, debug_sample=args.log_sample)
+    kwargs = bridge_kwargs(args)
+    # metrics would overwrite those of the running bridge
+    kwargs["metrics_interval"] = 0
+    kwargs["metrics_port"] = None
+    replaying = ReplayBridge(
+        args.db_host, args.db_port, args.broker_host, args.broker_port, **kwargs
+    )
+    count = 0
+    started = time.perf_counter()
+    for side, channel, message in journal.messages(args.journal):
+        replaying.routing(channel, message, db=side == "db")
+        count += 1
+    replaying.writer.flush()
+    elapsed = time.perf_counter() - started
+    logger.info(
+        "replayed %s messages in %.3fs, %.0f messages/sec",
+        count,
+        elapsed,
+        count / elapsed if elapsed else 0,
+    )
+    # let paho's network thread send queued mqtt outputs
+    time.sleep(0.5)
+
+
+def bridge_kwargs(args):
     # usually env vars a passed in by program
     # that imports bridge such as tangle-ui
     # include some basics by default
@@ -39,16 +264,63 @@ def main():
             "$BROKER_HOST": args.broker_host,
             "$BROKER_PORT": args.broker_port,
         }
+    return {
+        "allow_shell_calls": args.allow_shell_calls,
+        "env_vars": env_vars,
+        "routes_resync": args.resync_interval,
+        "flush_size": args.flush_size,
+        "flush_latency": args.flush_latency / 1000,
+        "call_workers": args.call_workers,
+        "call_limit": args.call_limit,
+        "call_queue": args.call_queue,
+        "call_overflow": args.call_overflow,
+        "call_timeout": args.call_timeout,
+        "metrics_interval": args.metrics_interval,
+        "metrics_port": args.metrics_port,
+        "route_cache": not args.no_route_cache,
+        "intake_size": args.intake_size,
+        "intake_overflow": args.intake_overflow,
+    }
 
-    print(args.db_host, args.db_port, args.broker_host, args.broker_port, env_vars)
-    # start bridge
-    bridge.Bridge(
+
+def start_bridge(args, worker=None):
+    logs.setup(verbose=args.verbose, debug_sample=args.log_sample)
+    logger.info(
+        "db %s:%s broker %s:%s worker %s",
         args.db_host,
         args.db_port,
         args.broker_host,
         args.broker_port,
-        allow_shell_calls=args.allow_shell_calls,
-        env_vars=env_vars,
+        worker,
     )
-    while True:
-        time.sleep(0.1)
+    kwargs = bridge_kwargs(args)
+    if args.shared_subscription:
+        # the broker splits messages between workers
+        kwargs["share_group"] = args.shared_subscription
+    elif worker is not None:
+        kwargs["shard"] = (worker, args.workers)
+    if worker is not None:
+        # db messages reach every worker, one routes them
+        kwargs["route_db"] = worker == 0
+    if args.metrics_port and worker is not None:
+        kwargs["metrics_port"] = args.metrics_port + worker
+    if args.journal:
+        # a journal per worker
+        kwargs["journal_dir"] = args.journal
+        if worker is not None:
+            kwargs["journal_dir"] = os.path.join(args.journal, str(worker))
+        kwargs["journal_segment_size"] = args.journal_segment_size * 1024 * 1024
+        kwargs["journal_sync"] = args.journal_sync / 1000
+    bridge_args = (args.db_host, args.db_port, args.broker_host, args.broker_port)
+    # start bridge
+    if args.engine == "asyncio":
+        # imported here since it requires redis.asyncio
+        from machinic_tangle import bridge_async
+
+        bridge_async.AsyncBridge(
+            *bridge_args, queue_size=args.queue_size, **kwargs
+        ).run()
+    else:
+        bridge.Bridge(*bridge_args, **kwargs)
+        while True:
+            time.sleep(0.1)
@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import logging
+import queue
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CallPool(object):
+    # runs route shell calls on a fixed number of worker
+    # threads so routing never waits on a call and a flood
+    # of messages cannot fork without limit
+    #
+    # each route may run route_limit calls at once
+    # (blocking calls run one at a time, in order) and
+    # queue up to queue_depth more. When a route's queue is
+    # full the overflow policy either drops the new call or
+    # coalesces by dropping the oldest waiting call.
+    # Calls are killed after timeout seconds and always
+    # waited on, so no zombies are left behind
+    def __init__(
+        self,
+        workers=4,
+        route_limit=2,
+        queue_depth=16,
+        overflow="drop",
+        timeout=30,
+        metrics=None,
+    ):
+        self.metrics = metrics
+        self.route_limit = max(1, route_limit)
+        self.queue_depth = max(1, queue_depth)
+        self.overflow = overflow
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # route hash : deque of waiting calls
+        self.pending = {}
+        # route hash : calls running or handed to a worker
+        self.running = collections.Counter()
+        # route hashes with a free slot and a waiting call
+        self.ready = queue.Queue()
+        self.dropped = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def limit(self, route):
+        if route.kind == "blocking":
+            return 1
+        return self.route_limit
+
+    def submit(self, route, call):
+        hashed = route.route_hash
+        with self.lock:
+            pending = self.pending.setdefault(hashed, collections.deque())
+            if len(pending) >= self.queue_depth:
+                if self.overflow == "coalesce":
+                    pending.popleft()
+                    self.coalesced += 1
+                else:
+                    self.dropped += 1
+                    return False
+            pending.append(call)
+            if self.running[hashed] < self.limit(route):
+                self.running[hashed] += 1
+                self.ready.put(hashed)
+        return True
+
+    def queued(self):
+        with self.lock:
+            return sum(len(pending) for pending in self.pending.values())
+
+    def release(self, hashed):
+        self.running[hashed] -= 1
+        if self.running[hashed] <= 0:
+            del self.running[hashed]
+            if not self.pending.get(hashed):
+                self.pending.pop(hashed, None)
+
+    def work(self):
+        while True:
+            hashed = self.ready.get()
+            with self.lock:
+                pending = self.pending.get(hashed)
+                if not pending:
+                    self.release(hashed)
+                    continue
+                call = pending.popleft()
+            self.run(call)
+            with self.lock:
+                if self.pending.get(hashed):
+                    # keep the slot, behind other ready routes
+                    self.ready.put(hashed)
+                else:
+                    self.release(hashed)
+
+    def run(self, call):
+        started = time.perf_counter()
+        try:
+            subprocess.run(call, stdin=subprocess.DEVNULL, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.timeouts += 1
+            logger.warning("shell call timed out: %s", call)
+        except Exception as ex:
+            logger.warning("shell call %s failed: %s", call, ex)
+        if self.metrics is not None:
+            self.metrics.observe("shell_call", time.perf_counter() - started)
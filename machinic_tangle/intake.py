@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import threading
+
+overflow_policies = ("block", "drop-oldest", "coalesce")
+
+
+class IntakeQueue(object):
+    # bounded queue of (channel, message, db) between the
+    # threads receiving messages and the routing thread
+    #
+    # when size messages are waiting the overflow policy
+    #   block        waits for room, so the broker connection
+    #                stops being read and the broker buffers
+    #   drop-oldest  drops the message waiting longest
+    #   coalesce     keeps only the latest message of each
+    #                channel, a new message replaces one still
+    #                waiting on its channel and keeps its place.
+    #                If the channel has none waiting the oldest
+    #                message is dropped
+    def __init__(self, size=10000, overflow="block"):
+        if overflow not in overflow_policies:
+            raise ValueError("unknown overflow policy {}".format(overflow))
+        self.size = max(1, size)
+        self.overflow = overflow
+        self.condition = threading.Condition()
+        # (channel, db) : message when coalescing,
+        # otherwise (channel, message, db) in arrival order
+        if overflow == "coalesce":
+            self.waiting = collections.OrderedDict()
+        else:
+            self.waiting = collections.deque()
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self.queued
+
+    def put(self, channel, message, db=False):
+        with self.condition:
+            if self.overflow == "coalesce":
+                key = (channel, db)
+                if key in self.waiting:
+                    self.waiting[key] = message
+                    self.coalesced += 1
+                    return
+                if self.queued >= self.size:
+                    self.drop_oldest()
+                self.waiting[key] = message
+            else:
+                if self.queued >= self.size:
+                    if self.overflow == "block":
+                        while self.queued >= self.size:
+                            self.condition.wait()
+                    else:
+                        self.drop_oldest()
+                self.waiting.append((channel, message, db))
+            self.queued += 1
+            self.condition.notify_all()
+
+    def drop_oldest(self):
+        # called with the condition held
+        self.take()
+        self.dropped += 1
+
+    def take(self):
+        # oldest (channel, message, db), called with the condition held
+        if self.overflow == "coalesce":
+            (channel, db), message = self.waiting.popitem(last=False)
+        else:
+            channel, message, db = self.waiting.popleft()
+        self.queued -= 1
+        return channel, message, db
+
+    def get(self):
+        with self.condition:
+            while not self.queued:
+                self.condition.wait()
+            item = self.take()
+            self.condition.notify_all()
+            return item
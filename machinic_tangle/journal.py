@@ -0,0 +1,222 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import json
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# record header: body length, crc32 of body, record type.
+# A zero length marks the unused end of a segment
+header = struct.Struct("<IIB")
+
+# record types, bodies are json lists
+#
+# message   [id, time, side, channel, message, fired route hashes]
+# failed    [id, ops] db write ops (kind, key, field, value) that failed
+# replayed  [ids] failed records written since
+MESSAGE = 1
+FAILED = 2
+REPLAYED = 3
+
+segment_glob = "journal-*.seg"
+
+
+class Journal(object):
+    # append-only journal of routed messages and failed
+    # db writes in memory mapped segment files under
+    # directory. Segments are preallocated to segment_size
+    # bytes and a new one is started when a record does not
+    # fit, the oldest are deleted beyond max_segments.
+    # Appends only copy into the map, a thread syncs dirty
+    # segments to disk every sync_interval seconds or once
+    # sync_every records are waiting
+    #
+    # failed writes not yet replayed are kept in pending,
+    # in order, and recovered from the segments on start
+    def __init__(
+        self,
+        directory,
+        segment_size=64 * 1024 * 1024,
+        max_segments=16,
+        sync_interval=0.05,
+        sync_every=1024,
+    ):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_segments)
+        self.sync_interval = sync_interval
+        self.sync_every = max(1, sync_every)
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        # failed record id : ops
+        self.pending = collections.OrderedDict()
+        self.next_id = 1
+        self.recover()
+        self.segment = None
+        self.map = None
+        self.position = 0
+        self.unsynced = 0
+        self.rewriting = False
+        self.rotate()
+        self.thread = threading.Thread(target=self.sync_loop, daemon=True)
+        self.thread.start()
+
+    def segments(self):
+        return sorted(self.directory.glob(segment_glob))
+
+    def recover(self):
+        replayed = set()
+        for record_type, body in read(self.directory):
+            if record_type == MESSAGE:
+                self.next_id = max(self.next_id, body[0] + 1)
+            elif record_type == FAILED:
+                self.next_id = max(self.next_id, body[0] + 1)
+                self.pending[body[0]] = [tuple(op) for op in body[1]]
+            elif record_type == REPLAYED:
+                replayed.update(body[0])
+        for record_id in replayed:
+            self.pending.pop(record_id, None)
+        if self.pending:
+            logger.info("%s failed db writes to replay", len(self.pending))
+
+    def rotate(self):
+        # called with the lock held, or before the sync thread starts
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            os.close(self.segment)
+        segments = self.segments()
+        number = 0
+        if segments:
+            number = int(segments[-1].stem.split("-")[-1]) + 1
+        path = self.directory / "journal-{:012d}.seg".format(number)
+        self.segment = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.segment, self.segment_size)
+        self.map = mmap.mmap(self.segment, self.segment_size)
+        self.position = 0
+        self.unsynced = 0
+        deleted = segments[: max(0, len(segments) + 1 - self.max_segments)]
+        if deleted and self.pending:
+            # pending failures are rewritten before deleting
+            # so a deleted segment cannot take them along
+            self.rewriting = True
+            for record_id, ops in self.pending.items():
+                self.write(FAILED, [record_id, ops])
+            self.rewriting = False
+        for path in deleted:
+            path.unlink()
+
+    def write(self, record_type, body):
+        # called with the lock held
+        data = json.dumps(body, separators=(",", ":")).encode()
+        size = header.size + len(data)
+        if size + header.size > self.segment_size:
+            logger.warning("journal record of %s bytes does not fit a segment", size)
+            return
+        if self.position + size + header.size > self.segment_size:
+            if self.rewriting:
+                logger.warning("pending db writes do not fit a journal segment")
+                return
+            self.rotate()
+        header.pack_into(
+            self.map, self.position, len(data), zlib.crc32(data), record_type
+        )
+        self.map[self.position + header.size : self.position + size] = data
+        self.position += size
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.synced.notify()
+
+    def message(self, side, channel, message, fired):
+        with self.lock:
+            record_id = self.next_id
+            self.next_id += 1
+            self.write(MESSAGE, [record_id, time.time(), side, channel, message, fired])
+        return record_id
+
+    def failed(self, ops):
+        ops = [tuple(op) for op in ops if op is not None]
+        if not ops:
+            return None
+        with self.lock:
+            record_id = self.next_id
+            self.next_id += 1
+            self.pending[record_id] = ops
+            self.write(FAILED, [record_id, ops])
+        return record_id
+
+    def replayed(self, record_ids):
+        with self.lock:
+            for record_id in record_ids:
+                self.pending.pop(record_id, None)
+            self.write(REPLAYED, [list(record_ids)])
+
+    def pending_writes(self):
+        # (record id, ops) oldest first
+        with self.lock:
+            return list(self.pending.items())
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self.map.flush()
+                self.unsynced = 0
+
+    def sync_loop(self):
+        while True:
+            with self.lock:
+                self.synced.wait(self.sync_interval)
+                if self.unsynced:
+                    self.map.flush()
+                    self.unsynced = 0
+
+
+def read(directory, recursive=False):
+    # (record type, body) from every segment in directory,
+    # and its subdirectories if recursive, oldest first,
+    # stopping at the end of each segment or at a torn record
+    directory = pathlib.Path(directory)
+    if recursive:
+        paths = directory.rglob(segment_glob)
+    else:
+        paths = directory.glob(segment_glob)
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            data = f.read()
+        position = 0
+        while position + header.size <= len(data):
+            length, crc, record_type = header.unpack_from(data, position)
+            if length == 0:
+                break
+            start = position + header.size
+            body = data[start : start + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                logger.warning("journal %s damaged at %s", path, position)
+                break
+            position = start + length
+            try:
+                yield record_type, json.loads(body)
+            except ValueError:
+                logger.warning("journal %s damaged at %s", path, position)
+                break
+
+
+def messages(directory):
+    # (side, channel, message) of journaled messages, worker
+    # journals in subdirectories included
+    for record_type, body in read(directory, recursive=True):
+        if record_type == MESSAGE:
+            yield body[2], body[3], body[4]
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import logging
+import logging.handlers
+import queue
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    # lets through at most burst records with the same
+    # logger, level and message format every interval
+    # seconds and reports how many were suppressed once
+    # the interval is over. Debug records are sampled,
+    # one of every debug_sample is kept
+    def __init__(self, burst=5, interval=10, debug_sample=1):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.interval = interval
+        self.debug_sample = max(1, debug_sample)
+        self.debug_seen = 0
+        # (name, level, msg) : [window start, count in window]
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and self.debug_sample > 1:
+            self.debug_seen += 1
+            if self.debug_seen % self.debug_sample:
+                return False
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is not None and window[1] > self.burst:
+                record.msg = "{} ({} similar messages suppressed)".format(
+                    record.msg, window[1] - self.burst
+                )
+            if len(self.windows) > 1024:
+                self.windows.clear()
+            self.windows[key] = [now, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self.burst
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # never blocks the logging thread, records are dropped
+    # when the queue is full
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(verbose=False, queue_size=10000, burst=5, interval=10, debug_sample=1):
+    # log machinic_tangle records through a queue so
+    # callers never write to stderr themselves, a listener
+    # thread does the writing
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(burst, interval, debug_sample))
+    stream = logging.StreamHandler()
+    stream.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+
+    logger = logging.getLogger("machinic_tangle")
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    logger.addHandler(handler)
+    logger.propagate = False
+    return listener
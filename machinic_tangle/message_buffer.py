@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import fnmatch
+import time
+
+
+class MessageBuffer(object):
+    # the last capacity (time, channel, text) messages of a
+    # view, the oldest is dropped as each new one arrives.
+    # Arrivals are also counted per channel in one second
+    # buckets, for rates over the last rate_window seconds
+    def __init__(self, capacity=5000, rate_window=10):
+        self.messages = collections.deque(maxlen=max(1, capacity))
+        self.rate_window = max(1, rate_window)
+        # channel : deque of [second, count]
+        self.arrivals = {}
+        self.received = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, channel, text, now=None):
+        if now is None:
+            now = time.time()
+        self.messages.append((now, channel, text))
+        self.received += 1
+        second = int(now)
+        buckets = self.arrivals.get(channel)
+        if buckets is None:
+            buckets = self.arrivals[channel] = collections.deque()
+        if buckets and buckets[-1][0] == second:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([second, 1])
+            self.expire(buckets, second)
+
+    def expire(self, buckets, second):
+        while buckets and buckets[0][0] <= second - self.rate_window:
+            buckets.popleft()
+
+    def rates(self, now=None):
+        # (channel, messages per second) busiest first, channels
+        # quiet for the whole window are forgotten
+        if now is None:
+            now = time.time()
+        second = int(now)
+        rates = []
+        for channel, buckets in list(self.arrivals.items()):
+            self.expire(buckets, second)
+            if not buckets:
+                del self.arrivals[channel]
+                continue
+            count = sum(count for _, count in buckets)
+            rates.append((channel, count / self.rate_window))
+        rates.sort(key=lambda rate: (-rate[1], str(rate[0])))
+        return rates
+
+    def snapshot(self):
+        return list(self.messages)
+
+
+def is_glob(pattern):
+    return any(char in pattern for char in "*?[")
+
+
+def matches(message, pattern):
+    # whether the channel or text of a message contains
+    # pattern, or its channel matches it when pattern is a glob
+    if not pattern:
+        return True
+    if is_glob(pattern):
+        return fnmatch.fnmatchcase(str(message[1]), pattern)
+    return pattern in str(message[1]) or pattern in message[2]
+
+
+def matching(messages, pattern):
+    return [message for message in messages if matches(message, pattern)]
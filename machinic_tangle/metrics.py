@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import bisect
+import collections
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# latency bucket upper bounds in seconds, 10us to 10s
+latency_buckets = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Histogram(object):
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=latency_buckets):
+        self.bounds = bounds
+        # the last count is for values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+    # counters and latency histograms kept by the bridge,
+    # updates are plain increments without locking so
+    # counts may be slightly off under heavy contention
+    #
+    # counters     name : Counter of label : count
+    # histograms   name : Histogram
+    # gauges       name : callable returning the current value
+    def __init__(self):
+        self.counters = collections.defaultdict(collections.Counter)
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}
+        # route hash : route, for labels
+        self.route_names = {}
+
+    def count(self, name, label="", value=1):
+        self.counters[name][label] += value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def gauge(self, name, source):
+        self.gauges[name] = source
+
+    def route_hit(self, route):
+        self.route_names[route.route_hash] = route.route
+        self.counters["route_hits"][route.route_hash] += 1
+
+    def forget_routes(self, kept):
+        # drop hits and names of routes not in kept, so
+        # removed routes do not linger in snapshots
+        kept = set(kept)
+        hits = self.counters["route_hits"]
+        for hashed in list(hits):
+            if hashed not in kept:
+                del hits[hashed]
+        for hashed in list(self.route_names):
+            if hashed not in kept:
+                self.route_names.pop(hashed, None)
+
+    def snapshot(self):
+        # flat field : value mapping for a db hash
+        snapshot = {}
+        for name, counter in list(self.counters.items()):
+            for label, value in list(counter.items()):
+                field = "{}:{}".format(name, label) if label else name
+                snapshot[field] = value
+        for name, histogram in list(self.histograms.items()):
+            snapshot["{}:count".format(name)] = histogram.count
+            snapshot["{}:sum".format(name)] = histogram.sum
+            snapshot["{}:p50".format(name)] = histogram.quantile(0.5)
+            snapshot["{}:p99".format(name)] = histogram.quantile(0.99)
+        for name, source in list(self.gauges.items()):
+            try:
+                snapshot[name] = source()
+            except Exception:
+                pass
+        return snapshot
+
+    def write_snapshot(self, redis_conn, key):
+        snapshot = self.snapshot()
+        pipe = redis_conn.pipeline()
+        # replace so fields no longer reported do not linger
+        pipe.delete(key)
+        if snapshot:
+            pipe.hmset(key, snapshot)
+        pipe.execute()
+
+    def prometheus(self, prefix="tangle_bridge"):
+        lines = []
+        for name, counter in list(self.counters.items()):
+            metric = "{}_{}_total".format(prefix, name)
+            lines.append("# TYPE {} counter".format(metric))
+            for label, value in list(counter.items()):
+                if name == "route_hits":
+                    labels = '{{route_hash="{}",route="{}"}}'.format(
+                        label, escape(self.route_names.get(label, ""))
+                    )
+                elif label:
+                    labels = '{{label="{}"}}'.format(escape(label))
+                else:
+                    labels = ""
+                lines.append("{}{} {}".format(metric, labels, value))
+        for name, histogram in list(self.histograms.items()):
+            metric = "{}_{}_seconds".format(prefix, name)
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(
+                    '{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative)
+                )
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append("{}_sum {}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        for name, source in list(self.gauges.items()):
+            try:
+                value = source()
+            except Exception:
+                continue
+            metric = "{}_{}".format(prefix, name)
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+    def publish(self, redis_conn, key, interval):
+        # write a snapshot to the db hash key every interval seconds
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(redis_conn, key)
+                except Exception as ex:
+                    logger.warning("metrics snapshot failed: %s", ex)
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, port, host="127.0.0.1"):
+        # prometheus text on http://host:port/metrics
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+def escape(label):
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,420 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import threading
+from machinic_tangle import routes
+
+logger = logging.getLogger(__name__)
+
+model_file = pathlib.Path(
+    pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling.tx")
+)
+
+
+@functools.lru_cache(maxsize=None)
+def metamodel():
+    # built on first use and shared by the whole process,
+    # textx is only imported when a route has to be parsed
+    from textx.metamodel import metamodel_from_file
+
+    return metamodel_from_file(model_file)
+
+
+@functools.lru_cache(maxsize=None)
+def grammar_hash():
+    with open(model_file, "rb") as f:
+        return hashlib.sha224(f.read()).hexdigest()
+
+
+class PathlingSyntaxError(Exception):
+    def __init__(self, route, position, expected):
+        self.route = route
+        self.position = position
+        self.expected = expected
+        super(PathlingSyntaxError, self).__init__(
+            "{}: expected {} at {!r}".format(
+                position, " or ".join(expected), route[position : position + 20]
+            )
+        )
+
+
+# model classes with the names and attributes textX
+# builds from pathling.tx, so either model can be compiled
+class Path(object):
+    __slots__ = ("source", "munge", "send_as", "destination")
+
+    def __init__(self, source, munge, send_as, destination):
+        self.source = source
+        self.munge = munge
+        self.send_as = send_as
+        self.destination = destination
+
+
+class ChannelExpression(object):
+    __slots__ = ("channel", "operator", "value")
+
+    def __init__(self, channel, operator, value):
+        self.channel = channel
+        self.operator = operator
+        self.value = value
+
+
+class HashKey(object):
+    __slots__ = ("name", "field")
+
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+
+
+class BlockingCall(object):
+    __slots__ = ("call", "args")
+
+    def __init__(self, call, args):
+        self.call = call
+        self.args = args
+
+
+class NonblockingCall(BlockingCall):
+    __slots__ = ()
+
+
+class MessageMunge(object):
+    __slots__ = ("template",)
+
+    def __init__(self, template):
+        self.template = template
+
+
+# terminals of pathling.tx and textX's STRING and INT,
+# compiled with the flags textX uses
+terminal = functools.partial(re.compile, flags=re.MULTILINE)
+whitespace = terminal(r"[\t\n\r ]*")
+# the regex alternatives of ChannelName and Munge, a re
+# alternation is an ordered choice like textX's
+channel_name = terminal(
+    r"(\w*|\+)(\/(\w*|\+))*\/(\w*|\+|#)(?![\w+#\/])|[+#](?![\w+#\/])"
+    r"|(\w+)(?![+#])|\/(\w+)(?![+#])"
+)
+munge = terminal(r"\$(\w+)|\/(\w+)|([^\s]+ )|(\w+)")
+string = terminal(r'("(\\"|[^"])*")|(\'(\\\'|[^\'])*\')')
+integer = terminal(r"[-+]?[0-9]+")
+operators = (">=", "<=", "==", ">", "<")
+send_symbols = ("->", ">>", "--")
+
+
+class Parser(object):
+    # recursive descent parser following the ordered
+    # choices of pathling.tx, whitespace is skipped before
+    # every terminal as textX does. Methods return None
+    # when a rule does not match and leave position where
+    # it was. The furthest failure is kept for errors
+    def __init__(self, route):
+        self.route = route
+        self.position = 0
+        self.failed_at = 0
+        self.expected = []
+
+    def fail(self, position, expected):
+        if position > self.failed_at:
+            self.failed_at = position
+            self.expected = [expected]
+        elif position == self.failed_at and expected not in self.expected:
+            self.expected.append(expected)
+        return None
+
+    def skip(self):
+        # position after any whitespace
+        position = self.position
+        if position < len(self.route) and self.route[position] in " \t\n\r":
+            return whitespace.match(self.route, position).end()
+        return position
+
+    def match(self, pattern, name):
+        position = self.skip()
+        matched = pattern.match(self.route, position)
+        if matched is None:
+            return self.fail(position, name)
+        self.position = matched.end()
+        return matched.group()
+
+    def literal(self, text):
+        position = self.skip()
+        if self.route.startswith(text, position):
+            self.position = position + len(text)
+            return text
+        return self.fail(position, repr(text))
+
+    def parse(self):
+        path = self.path()
+        if path is not None:
+            position = self.skip()
+            if position == len(self.route):
+                return path
+            self.fail(position, "EOF")
+        raise PathlingSyntaxError(self.route, self.failed_at, self.expected)
+
+    def path(self):
+        source = self.channel_name()
+        if source is None:
+            source = self.channel_expression()
+            if source is None:
+                return None
+        munge = self.message_munge()
+        send_as = None
+        for symbol in send_symbols:
+            send_as = self.literal(symbol)
+            if send_as is not None:
+                break
+        destination = self.channel_name()
+        if destination is None:
+            return None
+        return Path(source, munge, send_as, destination)
+
+    def channel_name(self):
+        name = self.match(channel_name, "ChannelName")
+        if name is not None:
+            return name
+        return self.hash_key() or self.shell_call()
+
+    def hash_key(self):
+        start = self.position
+        name = self.string()
+        if name is not None and self.literal("::") is not None:
+            field = self.string()
+            if field is not None:
+                return HashKey(name, field)
+        self.position = start
+        return None
+
+    def shell_call(self):
+        for opening, call_type in (("$$(", BlockingCall), ("$(", NonblockingCall)):
+            start = self.position
+            if self.literal(opening) is None:
+                continue
+            call = self.match(munge, "Munge")
+            if call is not None:
+                args = []
+                arg = self.match(munge, "Munge")
+                while arg is not None:
+                    args.append(arg)
+                    arg = self.match(munge, "Munge")
+                if self.literal(")") is not None:
+                    return call_type(call, args)
+            self.position = start
+        return None
+
+    def channel_expression(self):
+        start = self.position
+        if self.literal("(") is not None:
+            channel = self.channel_name()
+            if channel is not None:
+                for operator in operators:
+                    if self.literal(operator) is not None:
+                        value = self.match(integer, "INT")
+                        if value is not None and self.literal(")") is not None:
+                            return ChannelExpression(channel, operator, int(value))
+                        break
+        self.position = start
+        return None
+
+    def message_munge(self):
+        start = self.position
+        if self.literal("[") is not None:
+            template = self.string()
+            if template is not None and self.literal("]") is not None:
+                return MessageMunge(template)
+        self.position = start
+        return None
+
+    def string(self):
+        value = self.match(string, "STRING")
+        if value is None:
+            return None
+        # as textX converts STRING
+        return value[1:-1].replace(r"\"", '"').replace(r"\'", "'")
+
+
+def parse(route):
+    # pathling model of route, from the hand written parser
+    # and from textX when the parser does not accept the
+    # route, so textX has the final say on what is invalid
+    try:
+        return Parser(route).parse()
+    except PathlingSyntaxError:
+        return metamodel().model_from_str(route)
+
+
+def dump(model):
+    # nested tuples of a textX or Parser model, equal
+    # when both parsers agree
+    if model is None or isinstance(model, (str, int)):
+        return model
+    if isinstance(model, list):
+        return tuple(dump(item) for item in model)
+    fields = [
+        (name, dump(getattr(model, name)))
+        for name in (
+            "source",
+            "munge",
+            "send_as",
+            "destination",
+            "channel",
+            "operator",
+            "value",
+            "name",
+            "field",
+            "call",
+            "args",
+            "template",
+        )
+        if hasattr(model, name)
+    ]
+    return (model.__class__.__name__, tuple(fields))
+
+
+def cache_dir():
+    # MACHINIC_TANGLE_CACHE overrides the xdg cache location
+    directory = os.environ.get("MACHINIC_TANGLE_CACHE")
+    if directory is None:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        directory = os.path.join(base, "machinic_tangle")
+    return pathlib.Path(directory)
+
+
+class RouteCache(object):
+    # compiled routes on disk, one json file per grammar
+    # hash and routes.compiled_version so neither a grammar
+    # change nor a compile_path change reuses old parses,
+    # entries keyed by route hash. Entries are checked
+    # against the route string before use
+    #
+    # size  entries kept, older entries are dropped first
+    def __init__(self, path=None, size=50000):
+        if path is None:
+            path = cache_dir() / "pathling-{}-{}.json".format(
+                grammar_hash()[:16], routes.compiled_version
+            )
+        self.path = pathlib.Path(path)
+        self.size = size
+        self.lock = threading.Lock()
+        # route hash : CompiledRoute fields
+        self.entries = None
+        self.added = {}
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            logger.warning("ignoring route cache %s: %s", self.path, ex)
+        return {}
+
+    def get(self, hashed, route):
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.read()
+            fields = self.entries.get(hashed)
+        if fields is None or fields[1] != route:
+            return None
+        try:
+            return decode(fields)
+        except Exception:
+            return None
+
+    def put(self, compiled):
+        fields = list(compiled)
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.read()
+            self.entries[compiled.route_hash] = fields
+            self.added[compiled.route_hash] = fields
+
+    def save(self):
+        # merged with what other processes wrote since it
+        # was read and replaced in one rename
+        with self.lock:
+            if not self.added:
+                return
+            added = self.added
+            self.added = {}
+        entries = self.read()
+        entries.update(added)
+        if len(entries) > self.size:
+            entries = dict(list(entries.items())[-self.size :])
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            handle, temporary = tempfile.mkstemp(
+                dir=str(self.path.parent), prefix=self.path.name, suffix=".tmp"
+            )
+            with os.fdopen(handle, "w") as f:
+                json.dump(entries, f)
+            os.replace(temporary, self.path)
+        except Exception as ex:
+            logger.warning("route cache %s not saved: %s", self.path, ex)
+        with self.lock:
+            self.entries = entries
+
+
+def decode(fields):
+    # json lists back to the tuples compile_path builds
+    (
+        hashed,
+        route,
+        source,
+        expression,
+        template,
+        kind,
+        destination,
+        field,
+        args,
+        compiled,
+    ) = fields
+    return routes.CompiledRoute(
+        hashed,
+        route,
+        source,
+        tuple(expression) if expression is not None else None,
+        template,
+        kind,
+        destination,
+        field,
+        tuple(args),
+        tuple(tuple(tokens) for tokens in compiled),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def default_cache():
+    return RouteCache()
+
+
+def validate(route, cache=None):
+    # CompiledRoute for route, raises if route is not a
+    # valid pathling route. Uses and updates the on-disk
+    # cache unless cache is False
+    if cache is None:
+        cache = default_cache()
+    elif cache is False:
+        cache = None
+    compiled = routes.compile_route(route, parse, cache=cache)
+    if cache is not None:
+        cache.save()
+    return compiled
@@ -4,27 +4,234 @@
 #
 # Copyright (c) 2018, Galen Curwen-McAdams
 
-import os
+import argparse
+import itertools
+import json
+import multiprocessing
 import pathlib
-from textx.metamodel import metamodel_from_file
+import random
+import sys
+import time
+from machinic_tangle import pathling
+from machinic_tangle import routes
 
+# lings-path-validate [files]
+#
+# routes are parsed in a process pool and a result is
+# printed for each, in input order, as PASSED/FAILED text
+# or json lines. With no files the pathling_spec.txt
+# shipped with machinic_tangle is validated
+#
+# --compare also parses each route with textX and fails
+# routes where the hand written parser builds a different
+# model. --fuzz adds routes generated from the grammar and
+# mutated from the input, these only have to agree
 
-pathling_model_file = pathlib.Path(
-    pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling.tx")
+spec_file = pathlib.Path(
+    pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling_spec.txt")
 )
-pathling_metamodel = metamodel_from_file(pathling_model_file)
-passed = 0
-failed = 0
-
-with open("pathling_spec.txt", "r") as f:
-    for line in f.read().split("\n"):
-        if not line.startswith("#") and line:
-            try:
-                path = pathling_metamodel.model_from_str(line)
-                print("PASSED:{}\n".format(line))
-                passed += 1
-            except Exception as ex:
-                print("FAILED:\n{}\n{}\n".format(line, ex))
-                failed += 1
-
-print("passed: {}\nfailed: {}".format(passed, failed))
+
+
+def generate(rand):
+    # a random route following pathling.tx
+    def name():
+        return rand.choice(
+            [
+                "foo",
+                "/foo",
+                "/foo/bar",
+                "/foo/+",
+                "/foo/#",
+                "foo/+/bar",
+                "+",
+                "#",
+                "_1",
+                '"foo"::"bar"',
+                "'foo'::'b\\'r'",
+            ]
+        )
+
+    def munge():
+        return rand.choice(["$contents", "$message", "/bin", "create-glworb ", "x"])
+
+    def space():
+        return rand.choice(["", " ", "  ", "\t"])
+
+    route = ""
+    if rand.random() < 0.3:
+        route += "({}{}{}{}{})".format(
+            space(),
+            name(),
+            space(),
+            rand.choice(pathling.operators),
+            rand.choice(["1", "-1", "+20", "0"]),
+        )
+    else:
+        route += name()
+    if rand.random() < 0.4:
+        route += space() + '["{}"]'.format(
+            rand.choice(["$channel", "$channel:$message", "", 'a\\"b', "$foo bar"])
+        )
+    route += space() + rand.choice(pathling.send_symbols + ("",)) + space()
+    if rand.random() < 0.3:
+        route += rand.choice(["$(", "$$("])
+        route += " ".join(munge() for _ in range(rand.randint(1, 3))) + ")"
+    else:
+        route += name()
+    return route
+
+
+def mutate(rand, route):
+    pieces = list("/ab+#()\"'[]$:-><=01 \t") + ["->", ">>", "--", "$(", "::"]
+    chars = list(route)
+    for _ in range(rand.randint(1, 3)):
+        position = rand.randint(0, len(chars))
+        change = rand.random()
+        if change < 0.4 or not chars:
+            chars.insert(position, rand.choice(pieces))
+        elif change < 0.7:
+            del chars[min(position, len(chars) - 1)]
+        else:
+            chars[min(position, len(chars) - 1)] = rand.choice(pieces)
+    return "".join(chars)
+
+
+def read_routes(sources):
+    # (source, line number, route), skipping blank lines and comments
+    for source in sources:
+        if source == "-":
+            lines = sys.stdin
+        else:
+            lines = open(source, "r")
+        with lines:
+            for number, line in enumerate(lines, 1):
+                line = line.rstrip("\n")
+                if not line.startswith("#") and line:
+                    yield source, number, line
+
+
+def fuzz_routes(routes, count, seed=0):
+    rand = random.Random(seed)
+    routes = [route for _, _, route in routes] or [generate(rand)]
+    for i in range(count):
+        if i % 2:
+            route = mutate(rand, rand.choice(routes))
+        else:
+            route = generate(rand)
+        yield "fuzz", i, route
+
+
+def reference_dump(route):
+    try:
+        return pathling.dump(pathling.metamodel().model_from_str(route))
+    except Exception:
+        return None
+
+
+def validate(task):
+    source, number, route, compare = task
+    result = {"source": source, "line": number, "route": route}
+    started = time.perf_counter()
+    try:
+        # compiled as the bridge does, which also rejects
+        # sources that parse but cannot be routed
+        routes.compile_route(route, pathling.parse)
+        result["valid"] = True
+    except Exception as ex:
+        result["valid"] = False
+        result["error"] = str(ex)
+    result["seconds"] = time.perf_counter() - started
+    if compare:
+        try:
+            parsed = pathling.dump(pathling.Parser(route).parse())
+        except pathling.PathlingSyntaxError:
+            parsed = None
+        reference = reference_dump(route)
+        if parsed != reference:
+            result["differs"] = {"textx": reference, "parser": parsed}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="validate pathling routes, one per line"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="route files, - for stdin, defaults to the pathling spec",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="validating processes, defaults to cpu count",
+    )
+    parser.add_argument("--json", action="store_true", help="print json lines")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="fail routes the hand written parser and textX parse differently",
+    )
+    parser.add_argument(
+        "--fuzz",
+        type=int,
+        default=0,
+        help="compare both parsers on this many fuzzed routes",
+    )
+    args = parser.parse_args()
+
+    sources = args.files or [str(spec_file)]
+    if args.fuzz:
+        # fuzzed routes are mutated from the input, so it is read first
+        given = list(read_routes(sources))
+        tasks = itertools.chain(
+            ((source, number, route, args.compare) for source, number, route in given),
+            (
+                (source, number, route, True)
+                for source, number, route in fuzz_routes(given, args.fuzz)
+            ),
+        )
+    else:
+        tasks = (
+            (source, number, route, args.compare)
+            for source, number, route in read_routes(sources)
+        )
+
+    counts = {"passed": 0, "failed": 0, "fuzzed": 0, "differed": 0}
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap(validate, tasks, chunksize=64):
+            fuzzed = result["source"] == "fuzz"
+            if fuzzed:
+                counts["fuzzed"] += 1
+                failed = "differs" in result
+            else:
+                failed = not result["valid"] or "differs" in result
+                counts["failed" if failed else "passed"] += 1
+            if "differs" in result:
+                counts["differed"] += 1
+            if args.json:
+                print(json.dumps(result), flush=True)
+            elif failed:
+                print(
+                    "FAILED:\n{}\n{}\n".format(
+                        result["route"], result.get("error") or result["differs"]
+                    ),
+                    flush=True,
+                )
+            elif not fuzzed:
+                print("PASSED:{}\n".format(result["route"]), flush=True)
+
+    if args.json:
+        print(json.dumps({"summary": counts}))
+    else:
+        print(
+            "passed: {passed}\nfailed: {failed}\n"
+            "fuzzed: {fuzzed}\ndiffered: {differed}".format(**counts)
+        )
+    if counts["failed"] or counts["differed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
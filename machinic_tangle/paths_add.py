@@ -1,16 +1,117 @@
 import argparse
-import pathlib
-import hashlib
+import concurrent.futures
+import sys
 import redis
-from textx.metamodel import metamodel_from_file
+from machinic_tangle import pathling
+from machinic_tangle import routes
+
+
+def read_lines(sources):
+    # (source name, line number, line) from files, - is stdin
+    for source in sources:
+        if source == "-":
+            lines = sys.stdin.read().split("\n")
+        else:
+            with open(source, "r") as f:
+                lines = f.read().split("\n")
+        for number, line in enumerate(lines, 1):
+            yield source, number, line
+
+
+def check(route):
+    # None if route is valid, otherwise the error. Routes
+    # are compiled as the bridge does, so sources that parse
+    # but cannot be routed are rejected too
+    try:
+        routes.compile_route(route, pathling.parse)
+    except Exception as ex:
+        return str(ex)
+    return None
+
+
+def check_all(route_list, jobs=None, parallel_min=1000):
+    # errors for route_list, in order. Large lists
+    # are split across processes
+    if jobs == 1 or len(route_list) < parallel_min:
+        return [check(route) for route in route_list]
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(check, route_list, chunksize=256))
+
+
+def parse_lines(lines):
+    # routes to add and to remove, as in the tangle-ui route
+    # editor a line starting with - removes a route and one
+    # starting with # is a comment
+    added = []
+    removed = []
+    for source, number, line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("-"):
+            removed.append(line[1:].strip())
+        else:
+            added.append((source, number, line))
+    return added, removed
+
+
+def fetch_routes(redis_conn, routes_key):
+    return redis_conn.hgetall(routes_key)
 
 
 def main():
     # add a pathling route
     # $ lings-path-add "/foo -> bar"
+    #
+    # add and remove many, from files or stdin
+    # $ lings-path-add -f site.routes
+    # $ cat site.routes | lings-path-add -f -
+    #
+    # sync route sets between sites
+    # $ lings-path-add --export > site.routes
+    # $ lings-path-add --diff -f site.routes --db-host 10.0.0.2
+    # $ lings-path-add -f site.routes --replace --db-host 10.0.0.2
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("route", help="db host ip")
+    parser.add_argument("route", nargs="*", help="pathling routes to add")
+    parser.add_argument(
+        "-f",
+        "--file",
+        action="append",
+        default=[],
+        help="file of routes, one per line, - for stdin",
+    )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="remove routes in db that are not in the routes given",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="write nothing if any route is invalid",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="processes validating large route sets, defaults to cpu count",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--export",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="FILE",
+        help="write routes in db to FILE or stdout",
+    )
+    mode.add_argument(
+        "--diff",
+        action="store_true",
+        help="print the lines that would make db match the routes given,"
+        " routes to add and -routes to remove",
+    )
     parser.add_argument("--db-host", default="127.0.0.1", help="db host ip")
     parser.add_argument("--db-port", type=int, default=6379, help="db port")
     args = parser.parse_args()
@@ -19,17 +120,78 @@ def main():
     redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
     routes_key = "machinic:routes:{}:{}".format(args.db_host, args.db_port)
 
-    # pathling model
-    pathling_model_file = pathlib.Path(
-        pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling.tx")
-    )
-    pathling_metamodel = metamodel_from_file(pathling_model_file)
-    route = args.route
+    if args.export is not None:
+        exported = "".join(
+            route + "\n"
+            for route in sorted(fetch_routes(redis_conn, routes_key).values())
+        )
+        if args.export == "-":
+            sys.stdout.write(exported)
+        else:
+            with open(args.export, "w") as f:
+                f.write(exported)
+        return
 
-    try:
-        # validate path
-        pathling_metamodel.model_from_str(route)
-        route_hash = hashlib.sha224(route.encode()).hexdigest()
-        redis_conn.hmset(routes_key, {route_hash: route})
-    except Exception as ex:
-        print(ex)
+    if len(args.route) == 1 and not args.file and not (args.replace or args.diff):
+        route = args.route[0]
+        try:
+            # validate path
+            pathling.validate(route)
+            route_hash = routes.route_hash(route)
+            redis_conn.hmset(routes_key, {route_hash: route})
+        except Exception as ex:
+            print(ex)
+        return
+
+    lines = [("argument", number, route) for number, route in enumerate(args.route, 1)]
+    added, removed = parse_lines(lines + list(read_lines(args.file)))
+
+    errors = check_all([route for _, _, route in added], args.jobs)
+    valid = {}
+    invalid = 0
+    for (source, number, route), error in zip(added, errors):
+        if error is None:
+            valid[routes.route_hash(route)] = route
+        else:
+            # commented out with the error beneath, as the
+            # tangle-ui route editor does
+            print(
+                "{}:{}:\n#{}\n#{}".format(source, number, route, error),
+                file=sys.stderr,
+            )
+            invalid += 1
+    removed_hashes = {routes.route_hash(route) for route in removed}
+
+    if args.diff or args.replace:
+        db_routes = fetch_routes(redis_conn, routes_key)
+        if args.replace:
+            removed_hashes |= db_routes.keys() - valid.keys()
+        if args.diff:
+            differences = 0
+            for hashed in sorted(valid.keys() - db_routes.keys(), key=valid.get):
+                print(valid[hashed])
+                differences += 1
+            for hashed in sorted(db_routes.keys() - valid.keys(), key=db_routes.get):
+                print("-" + db_routes[hashed])
+                differences += 1
+            sys.exit(1 if differences or invalid else 0)
+
+    if invalid and args.strict:
+        print("{} invalid routes, nothing written".format(invalid), file=sys.stderr)
+        sys.exit(1)
+
+    # one round trip, applied atomically
+    pipe = redis_conn.pipeline(transaction=True)
+    if removed_hashes:
+        pipe.hdel(routes_key, *removed_hashes)
+    if valid:
+        pipe.hmset(routes_key, valid)
+    pipe.execute()
+    print(
+        "added: {}\nremoved: {}\ninvalid: {}".format(
+            len(valid), len(removed_hashes), invalid
+        ),
+        file=sys.stderr,
+    )
+    if invalid:
+        sys.exit(1)
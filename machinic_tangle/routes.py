@@ -0,0 +1,457 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import functools
+import hashlib
+import logging
+import operator
+import re
+
+logger = logging.getLogger(__name__)
+
+# a route parsed once from its pathling string
+#
+# source      channel name, for a ChannelExpression the
+#             channel inside the expression
+# expression  None or (operator, value) of a ChannelExpression
+# template    None or MessageMunge template string
+# kind        publish, mqtt, set, hash, nonblocking, blocking or
+#             None if the send symbol and destination do not combine
+# destination channel, key, hash name or shell call
+# field       hash field when kind is hash
+# args        shell call args when kind is a call
+# compiled    templates rendered to produce the output, the
+#             munge template or the shell call and its args
+CompiledRoute = collections.namedtuple(
+    "CompiledRoute",
+    [
+        "route_hash",
+        "route",
+        "source",
+        "expression",
+        "template",
+        "kind",
+        "destination",
+        "field",
+        "args",
+        "compiled",
+    ],
+)
+
+# version of what compile_path produces, part of the route
+# cache key. Increase it whenever compile_path changes the
+# CompiledRoute it builds for a route
+compiled_version = 1
+
+# $ followed by a word, so $messageX is the variable
+# $messageX and not $message followed by X
+template_variable = re.compile(r"(\$\w+)")
+
+
+def route_hash(route):
+    # routes are stored in the routes hash using
+    # the sha224 of the route string as field
+    return hashlib.sha224(route.encode()).hexdigest()
+
+
+def compile_template(template):
+    # split into alternating literal and variable slots,
+    # (literal, variable, literal, ..., literal)
+    return tuple(template_variable.split(template))
+
+
+def render_template(tokens, message, channel, env):
+    # env values are strings, unknown variables are
+    # left in place as written
+    if len(tokens) == 1:
+        return tokens[0]
+    parts = list(tokens)
+    for i in range(1, len(parts), 2):
+        name = parts[i]
+        if name == "$message":
+            parts[i] = message
+        elif name == "$channel":
+            parts[i] = channel
+        else:
+            parts[i] = env.get(name, name)
+    return "".join(parts)
+
+
+operators = {
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def predicate(expression_operator, value):
+    # one closure per distinct (operator, value), shared
+    # by every route with the same condition
+    compare = operators[expression_operator]
+    return lambda number: compare(number, value)
+
+
+def payload_number(message):
+    # None if the payload is not a number
+    try:
+        return float(message)
+    except ValueError:
+        return None
+
+
+def compile_path(path, route, hashed=None):
+    if hashed is None:
+        hashed = route_hash(route)
+
+    expression = None
+    source = path.source
+    if source.__class__.__name__ == "ChannelExpression":
+        expression = (source.operator, source.value)
+        source = source.channel
+    if not isinstance(source, str):
+        # hash keys and shell calls are valid channel names
+        # in the grammar but nothing can be received on them
+        raise ValueError(
+            "route source must be a channel or topic, not a {}".format(
+                source.__class__.__name__
+            )
+        )
+    if not valid_topic_filter(source):
+        raise ValueError("{} is not a valid mqtt topic filter".format(source))
+
+    template = None
+    if path.munge is not None:
+        template = path.munge.template
+
+    kind = None
+    field = None
+    args = ()
+    destination = path.destination
+    destination_type = destination.__class__.__name__
+    if isinstance(destination, str):
+        if path.send_as == "->":
+            # /bar is an mqtt topic, bar a db channel
+            kind = "mqtt" if destination.startswith("/") else "publish"
+        elif path.send_as == ">>":
+            kind = "set"
+    elif destination_type == "HashKey":
+        if path.send_as == ">>":
+            kind = "hash"
+            field = destination.field
+            destination = destination.name
+    elif destination_type in ("BlockingCall", "NonblockingCall"):
+        if path.send_as == "--":
+            kind = "blocking" if destination_type == "BlockingCall" else "nonblocking"
+            # strip trailing spaces that may cause subprocess call problems
+            args = tuple(arg.strip(" ") for arg in destination.args)
+            destination = destination.call.strip(" ")
+
+    if kind is None and not isinstance(destination, str):
+        # nothing is sent, and the model object would not
+        # survive the route cache
+        destination = None
+
+    compiled = ()
+    if kind in ("blocking", "nonblocking"):
+        compiled = tuple(compile_template(part) for part in (destination, *args))
+    elif template is not None:
+        compiled = (compile_template(template),)
+
+    return CompiledRoute(
+        hashed,
+        route,
+        source,
+        expression,
+        template,
+        kind,
+        destination,
+        field,
+        args,
+        compiled,
+    )
+
+
+def compile_route(route, parse, hashed=None, cache=None):
+    # parse returns the pathling model of a route string,
+    # called only when the route is not found in cache
+    if hashed is None:
+        hashed = route_hash(route)
+    if cache is not None:
+        compiled = cache.get(hashed, route)
+        if compiled is not None:
+            return compiled
+    compiled = compile_path(parse(route), route, hashed)
+    if cache is not None:
+        cache.put(compiled)
+    return compiled
+
+
+def is_topic_filter(source):
+    return "+" in source or "#" in source
+
+
+def valid_topic_filter(topic_filter):
+    # + and # only as whole levels and # only as the
+    # last level, brokers and paho refuse other filters
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if level in ("+", "#"):
+            if level == "#" and i != len(levels) - 1:
+                return False
+        elif "+" in level or "#" in level:
+            return False
+    return True
+
+
+def covers(topic_filter, other):
+    # True if every topic matched by other is also
+    # matched by topic_filter
+    levels = topic_filter.split("/")
+    other_levels = other.split("/")
+    for i, level in enumerate(levels):
+        if level == "#":
+            return True
+        if i >= len(other_levels):
+            return False
+        other_level = other_levels[i]
+        if level == "+":
+            if other_level == "#":
+                return False
+        elif level != other_level:
+            return False
+    return len(other_levels) == len(levels)
+
+
+def minimal_filters(sources):
+    # smallest set of topic filters that matches every
+    # topic matched by sources, filters covered by a
+    # wildcard filter are left out
+    sources = set(sources)
+    if "#" in sources:
+        return {"#"}
+    wildcards = [source for source in sources if is_topic_filter(source)]
+    return {
+        source
+        for source in sources
+        if not any(
+            wildcard != source and covers(wildcard, source) for wildcard in wildcards
+        )
+    }
+
+
+def is_db_source(source):
+    # foo is a db channel or key, /foo an mqtt topic
+    return "/" not in source and not is_topic_filter(source)
+
+
+class TopicNode(object):
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie(object):
+    # matches mqtt topics against topic filters, a topic
+    # is split into levels on / and a filter level of
+    # + matches a single level, # matches all remaining
+    # levels including the parent level
+    def __init__(self):
+        self.root = TopicNode()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split("/"):
+            if level not in node.children:
+                node.children[level] = TopicNode()
+            node = node.children[level]
+        node.values.append(value)
+        self.size += 1
+
+    def match(self, topic):
+        levels = topic.split("/")
+        matched = []
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                # wildcards do not match topics beginning with $
+                wildcards = not (depth == 0 and level.startswith("$"))
+                if wildcards and "#" in node.children:
+                    matched.extend(node.children["#"].values)
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if wildcards and "+" in node.children:
+                    next_nodes.append(node.children["+"])
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            matched.extend(node.values)
+            # foo/# also matches foo
+            if "#" in node.children:
+                matched.extend(node.children["#"].values)
+        return matched
+
+
+class RouteIndex(object):
+    # routes indexed by source so a message only visits
+    # routes that can fire for its channel
+    #
+    # plain sources are looked up by exact channel, mqtt
+    # wildcard filters and ChannelExpression sources are
+    # held in a TopicTrie
+    def __init__(self, routes=None, cache_size=4096):
+        self.exact = {}
+        self.filters = TopicTrie()
+        self.cache_size = cache_size
+        # channel : matched routes from filters
+        self.cache = {}
+        if routes is not None:
+            for route in routes:
+                self.add(route)
+
+    def add(self, route):
+        if route.expression is None and not is_topic_filter(route.source):
+            self.exact.setdefault(route.source, []).append(route)
+        else:
+            self.filters.add(route.source, route)
+        self.cache.clear()
+
+    def match(self, channel):
+        matched = self.exact.get(channel, ())
+        if self.filters:
+            try:
+                filtered = self.cache[channel]
+            except KeyError:
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                filtered = tuple(self.filters.match(channel))
+                self.cache[channel] = filtered
+            if filtered:
+                return (*matched, *filtered)
+        return matched
+
+
+class RouteTable(object):
+    def __init__(self, parse, cache=None):
+        # parse returns the pathling model of a route
+        # string, cache is a pathling.RouteCache or None
+        self.parse = parse
+        self.cache = cache
+        # route hash : CompiledRoute
+        self.routes = {}
+        self.index = RouteIndex()
+        # routes whose source is a db channel or key
+        self.db_index = RouteIndex()
+        self.db_sources = frozenset()
+        # route hash : route string that failed to parse,
+        # kept so invalid routes are not reparsed on every sync
+        self.invalid = {}
+
+    def compile(self, route, hashed=None):
+        return compile_route(route, self.parse, hashed, self.cache)
+
+    def known(self):
+        return self.routes.keys() | self.invalid.keys()
+
+    def update(self, added=None, removed=None):
+        # added is a route hash : route mapping, removed an
+        # iterable of route hashes. Only routes not seen
+        # before are parsed
+        routes = dict(self.routes)
+        invalid = dict(self.invalid)
+        changed = False
+        for hashed in removed or ():
+            invalid.pop(hashed, None)
+            if routes.pop(hashed, None) is not None:
+                changed = True
+        for hashed, route in (added or {}).items():
+            compiled = routes.get(hashed)
+            if compiled is not None and compiled.route == route:
+                continue
+            if invalid.get(hashed) == route:
+                continue
+            try:
+                routes[hashed] = self.compile(route, hashed)
+                invalid.pop(hashed, None)
+                changed = True
+            except Exception as ex:
+                logger.warning("invalid route %s: %s", route, ex)
+                invalid[hashed] = route
+                if routes.pop(hashed, None) is not None:
+                    changed = True
+        # swap rather than mutate so a reader never sees a partial table
+        if changed:
+            self.index = RouteIndex(routes.values())
+            db_sourced = [r for r in routes.values() if is_db_source(r.source)]
+            self.db_index = RouteIndex(db_sourced)
+            self.db_sources = frozenset(r.source for r in db_sourced)
+        self.routes = routes
+        self.invalid = invalid
+        if self.cache is not None:
+            self.cache.save()
+        return changed
+
+    def sync(self, db_routes):
+        # db_routes is the complete route hash : route mapping
+        # stored in db, routes no longer in db are removed
+        removed = self.known() - db_routes.keys()
+        return self.update(db_routes, removed)
+
+    def match(self, channel):
+        return self.index.match(channel)
+
+    def sources(self):
+        return {route.source for route in self.routes.values()}
+
+    def match_db(self, channel):
+        return self.db_index.match(channel)
+
+    def cycles(self):
+        # routes on or between cycles, where outputs come
+        # back to routes that led to them. Found by pruning
+        # routes that nothing routes into or that route into
+        # nothing until only cycles are left
+        edges = {}
+        for hashed, route in self.routes.items():
+            targets = ()
+            if route.kind == "mqtt":
+                targets = self.match(route.destination)
+            elif route.kind in ("publish", "set"):
+                targets = self.match_db(route.destination)
+            edges[hashed] = {target.route_hash for target in targets}
+        reverse = {hashed: set() for hashed in edges}
+        for hashed, targets in edges.items():
+            for target in targets:
+                reverse[target].add(hashed)
+        outgoing = {hashed: len(targets) for hashed, targets in edges.items()}
+        incoming = {hashed: len(sources) for hashed, sources in reverse.items()}
+        pruned = set()
+        prune = [h for h in edges if not outgoing[h] or not incoming[h]]
+        while prune:
+            hashed = prune.pop()
+            if hashed in pruned:
+                continue
+            pruned.add(hashed)
+            for target in edges[hashed]:
+                incoming[target] -= 1
+                if not incoming[target]:
+                    prune.append(target)
+            for source in reverse[hashed]:
+                outgoing[source] -= 1
+                if not outgoing[source]:
+                    prune.append(source)
+        return [self.routes[hashed] for hashed in edges if hashed not in pruned]
@@ -0,0 +1,303 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import logging
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# a basic service set seen by a scan, signal in dBm and
+# frequency in MHz are None when the driver does not report
+# them. last_seen is the time of the latest scan that saw it
+Bss = collections.namedtuple(
+    "Bss", "bssid ssid signal frequency channel encrypted last_seen"
+)
+
+commands = {
+    "iw": ["sudo", "iw", "dev", "{iface}", "scan"],
+    "iwlist": ["sudo", "iwlist", "{iface}", "scan"],
+}
+
+iwlist_cell = re.compile(r"Cell \d+ - Address: ([0-9A-Fa-f:]{17})")
+iwlist_frequency = re.compile(r"Frequency:([\d.]+) GHz(?: \(Channel (\d+)\))?")
+iwlist_signal = re.compile(r"Signal level[=:](-?[\d.]+)\s*dBm")
+iw_bss = re.compile(r"BSS ([0-9A-Fa-f:]{17})")
+escaped = re.compile(r"\\x([0-9A-Fa-f]{2})")
+
+
+def unescape(ssid):
+    # iw and iwlist print bytes outside printable ascii
+    # as \xNN, an ssid is up to 32 bytes of any value
+    if "\\x" not in ssid:
+        return ssid
+    raw = bytearray()
+    position = 0
+    for match in escaped.finditer(ssid):
+        raw.extend(ssid[position : match.start()].encode())
+        raw.append(int(match.group(1), 16))
+        position = match.end()
+    raw.extend(ssid[position:].encode())
+    return raw.decode("utf-8", "replace")
+
+
+def frequency_channel(frequency):
+    # ieee 802.11 channel of a frequency in MHz
+    if frequency is None:
+        return None
+    if frequency == 2484:
+        return 14
+    if 2412 <= frequency < 2484:
+        return int((frequency - 2407) // 5)
+    if 5000 <= frequency < 5900:
+        return int((frequency - 5000) // 5)
+    return None
+
+
+def bss(fields):
+    frequency = fields.get("frequency")
+    channel = fields.get("channel")
+    if channel is None:
+        channel = frequency_channel(frequency)
+    ssid = fields.get("ssid", "")
+    if not ssid.strip("\x00"):
+        # hidden, some drivers report the ssid length as nuls
+        ssid = ""
+    return Bss(
+        fields["bssid"],
+        ssid,
+        fields.get("signal"),
+        frequency,
+        channel,
+        fields.get("encrypted", False),
+        None,
+    )
+
+
+def parse_iwlist(output):
+    # Bss of each cell in iwlist <iface> scan output
+    found = []
+    fields = None
+    for line in output.splitlines():
+        line = line.strip()
+        cell = iwlist_cell.match(line)
+        if cell:
+            fields = {"bssid": cell.group(1).lower()}
+            found.append(fields)
+        elif fields is None:
+            continue
+        elif line.startswith("ESSID:"):
+            ssid = line[len("ESSID:") :]
+            if ssid.startswith('"') and ssid.endswith('"'):
+                ssid = ssid[1:-1]
+            fields["ssid"] = unescape(ssid)
+        elif line.startswith("Frequency:"):
+            frequency = iwlist_frequency.match(line)
+            if frequency:
+                fields["frequency"] = int(round(float(frequency.group(1)) * 1000))
+                if frequency.group(2):
+                    fields["channel"] = int(frequency.group(2))
+        elif line.startswith("Channel:"):
+            try:
+                fields["channel"] = int(line[len("Channel:") :])
+            except ValueError:
+                pass
+        elif line.startswith("Encryption key:"):
+            fields["encrypted"] = line.endswith(":on")
+        else:
+            signal = iwlist_signal.search(line)
+            if signal:
+                fields["signal"] = float(signal.group(1))
+    return [bss(fields) for fields in found]
+
+
+def parse_iw(output):
+    # Bss of each BSS in iw dev <iface> scan output
+    found = []
+    fields = None
+    for line in output.splitlines():
+        if line.startswith("BSS "):
+            match = iw_bss.match(line)
+            fields = None
+            if match:
+                fields = {"bssid": match.group(1).lower()}
+                found.append(fields)
+            continue
+        if fields is None:
+            continue
+        line = line.strip()
+        if line.startswith("SSID:") and "ssid" not in fields:
+            fields["ssid"] = unescape(line[len("SSID:") :].strip())
+        elif line.startswith("freq:"):
+            try:
+                fields["frequency"] = int(float(line[len("freq:") :]))
+            except ValueError:
+                pass
+        elif line.startswith("signal:"):
+            try:
+                fields["signal"] = float(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+        elif line.startswith("DS Parameter set: channel"):
+            fields["channel"] = int(line.rsplit(" ", 1)[-1])
+        elif line.startswith("* primary channel:") and "channel" not in fields:
+            fields["channel"] = int(line.rsplit(" ", 1)[-1])
+        elif line.startswith("capability:") and " Privacy" in line:
+            fields["encrypted"] = True
+        elif line.startswith("RSN:") or line.startswith("WPA:"):
+            fields["encrypted"] = True
+    return [bss(fields) for fields in found]
+
+
+parsers = {"iw": parse_iw, "iwlist": parse_iwlist}
+
+
+def default_tool():
+    if shutil.which("iw") or not shutil.which("iwlist"):
+        return "iw"
+    return "iwlist"
+
+
+def run_scan(iface, tool=None, timeout=30):
+    # Bss found by one scan of iface, raises if the scan fails
+    if tool is None:
+        tool = default_tool()
+    command = [part.format(iface=iface) for part in commands[tool]]
+    output = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
+        check=True,
+    ).stdout.decode("utf-8", "replace")
+    return parsers[tool](output)
+
+
+class Scanner(object):
+    # one long lived thread scanning iface every interval
+    # seconds while anything is subscribed, so there is
+    # never more than one scan in flight however many
+    # consumers there are. Results are cached by bssid
+    # until not seen for ttl seconds
+    #
+    # subscribers are called on the scanner thread with the
+    # cached Bss list, strongest first, after every scan
+    def __init__(self, iface, interval=10, ttl=60, tool=None, timeout=30):
+        self.iface = iface
+        self.interval = interval
+        self.ttl = ttl
+        self.tool = tool
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        # bssid : Bss
+        self.cache = {}
+        self.subscribers = []
+        self.requested = False
+        self.stopped = False
+        self.next_scan = 0
+        self.scans = 0
+        self.failures = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, callback):
+        with self.condition:
+            if callback not in self.subscribers:
+                self.subscribers.append(callback)
+            self.condition.notify_all()
+
+    def unsubscribe(self, callback):
+        with self.condition:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def request(self):
+        # scan as soon as the scan in flight, if any, is done
+        with self.condition:
+            self.requested = True
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def due(self):
+        # called with the condition held
+        return self.subscribers and (
+            self.requested or time.monotonic() >= self.next_scan
+        )
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.due():
+                    timeout = None
+                    if self.subscribers:
+                        timeout = max(0, self.next_scan - time.monotonic())
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                self.requested = False
+            self.scan()
+            self.next_scan = time.monotonic() + self.interval
+            results = self.results()
+            with self.condition:
+                subscribers = list(self.subscribers)
+            for callback in subscribers:
+                try:
+                    callback(results)
+                except Exception as ex:
+                    logger.warning("scan subscriber failed: %s", ex)
+
+    def scan(self):
+        try:
+            found = run_scan(self.iface, self.tool, self.timeout)
+        except Exception as ex:
+            self.failures += 1
+            logger.warning("%s scan failed: %s", self.iface, ex)
+            return
+        now = time.time()
+        with self.condition:
+            self.scans += 1
+            for seen in found:
+                self.cache[seen.bssid] = seen._replace(last_seen=now)
+
+    def results(self):
+        # cached Bss seen within ttl, strongest first
+        cutoff = time.time() - self.ttl
+        with self.condition:
+            for bssid, seen in list(self.cache.items()):
+                if seen.last_seen < cutoff:
+                    del self.cache[bssid]
+            cached = list(self.cache.values())
+        return sorted(
+            cached, key=lambda seen: (seen.signal is None, -(seen.signal or 0))
+        )
+
+    def ssids(self):
+        ssids = []
+        for seen in self.results():
+            if seen.ssid and seen.ssid not in ssids:
+                ssids.append(seen.ssid)
+        return ssids
+
+
+scanners = {}
+scanners_lock = threading.Lock()
+
+
+def scanner(iface, **kwargs):
+    # the Scanner of iface shared by everything in this
+    # process, kwargs only apply when it is created
+    with scanners_lock:
+        if iface not in scanners:
+            scanners[iface] = Scanner(iface, **kwargs)
+        return scanners[iface]
@@ -7,24 +7,28 @@
 import argparse
 import atexit
 import attr
+import collections
 import redis
 import subprocess
 import json
 import time
 import pathlib
 import fnmatch
-import hashlib
 import threading
 import jinja2
 import shutil
 import operator
+import uuid
 import paho.mqtt.client as mosquitto
 import paho.mqtt.publish
-from textx.metamodel import metamodel_from_file
 import netifaces
 from ma_cli import data_models
 from machinic_tangle import associative
 from machinic_tangle import bridge
+from machinic_tangle import message_buffer
+from machinic_tangle import pathling
+from machinic_tangle import routes
+from machinic_tangle import scanner
 
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -35,6 +39,9 @@ from kivy.uix.button import Button
 from kivy.uix.checkbox import CheckBox
 from kivy.properties import BooleanProperty
 from kivy.uix.dropdown import DropDown
+from kivy.uix.togglebutton import ToggleButton
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 
 r_ip, r_port = data_models.service_connection()
 binary_r = redis.StrictRedis(host=r_ip, port=r_port)
@@ -149,17 +156,24 @@ class SsidMap(BoxLayout):
         self.ssid_source = ssid_source
         self.app = app
         super(SsidMap, self).__init__()
+        # ssid : latest provisioning event
+        self.provisioning = {}
         self.ssid_container = BoxLayout(orientation="vertical")
         self.ssid_list = TextInput()
         self.ssid_container.add_widget(self.ssid_list)
         self.add_widget(self.ssid_container)
 
-    def update_ssids(self, ssids):
+    def provision_event(self, event):
+        # called on the provisioning worker threads
+        self.provisioning[event["ssid"]] = event["event"]
+
+    def update_ssids(self, results):
+        # called on the scanner thread with the Bss in range
+        ssids = [bss.ssid for bss in results if bss.ssid]
         try:
             highlight_patterns = self.ssid_source.associate_patterns
         except Exception as ex:
             highlight_patterns = []
-        self.ssid_list.text = ""
         for ssid in ssids:
             for pattern in highlight_patterns:
                 if fnmatch.fnmatch(ssid.lower(), pattern.lower()):
@@ -170,9 +184,7 @@ class SsidMap(BoxLayout):
                     template_vars["device_id"] = "foo"
                     template_vars["ssid"] = self.ssid_source.config_vars["ap_ssid"]
                     template_vars["ssid_pass"] = self.ssid_source.config_vars["ap_pass"]
-                    template_vars[
-                        "mqtt_host"
-                    ] = (
+                    template_vars["mqtt_host"] = (
                         self.ssid_source.ap_ip
                     )  # "192.168.12.1" # ap0 iface inet address
                     template_vars["mqtt_port"] = 1883
@@ -181,13 +193,25 @@ class SsidMap(BoxLayout):
                         .from_string(self.ssid_source.template_input.text)
                         .render(template_vars)
                     )
+                    # provisioned by the interface workers,
+                    # ssids already handled are not queued again
                     try:
-                        associative.associate(
-                            self.ssid_source.scan_iface, ssid, template, retries=5
-                        )
+                        self.ssid_source.provisioner.offer(ssid, template)
                     except Exception as ex:
                         pass
-            self.ssid_list.text += "{}\n".format(ssid)
+        now = time.time()
+        text = "".join(
+            "{} {} {} dBm ch {} {:.0f}s ago {}\n".format(
+                bss.ssid or "<hidden>",
+                bss.bssid,
+                "?" if bss.signal is None else bss.signal,
+                "?" if bss.channel is None else bss.channel,
+                now - bss.last_seen,
+                self.provisioning.get(bss.ssid, ""),
+            )
+            for bss in results
+        )
+        Clock.schedule_once(lambda dt: setattr(self.ssid_list, "text", text))
 
 
 class BrokerService(BoxLayout):
@@ -347,10 +371,6 @@ class PathlingWidget(BoxLayout):
             )
         )
         self.add_widget(test_row)
-        self.pathling_model_file = pathlib.Path(
-            pathlib.PurePath(pathlib.Path(__file__).parents[0], "pathling.tx")
-        )
-        self.pathling_metamodel = metamodel_from_file(self.pathling_model_file)
         self.fetch_routes()
 
     def channel_test(self, channel, message):
@@ -366,7 +386,7 @@ class PathlingWidget(BoxLayout):
             elif not route.startswith("#"):
                 try:
                     # validate path
-                    self.pathling_metamodel.model_from_str(route)
+                    pathling.validate(route)
                     self.add_route(route)
                 except Exception as ex:
                     print(ex)
@@ -381,11 +401,11 @@ class PathlingWidget(BoxLayout):
     def remove_route(self, route):
         if route.startswith("-"):
             route = route.split("-", 1)[-1].strip()
-        route_hash = hashlib.sha224(route.encode()).hexdigest()
+        route_hash = routes.route_hash(route)
         redis_conn.hdel(self.routes_key, route_hash)
 
     def add_route(self, route):
-        route_hash = hashlib.sha224(route.encode()).hexdigest()
+        route_hash = routes.route_hash(route)
         redis_conn.hmset(self.routes_key, {route_hash: route})
 
     def fetch_routes(self):
@@ -416,12 +436,9 @@ class WirelessDetails(BoxLayout):
         self.add_widget(Label(text="template:", height=30, size_hint_y=None))
         self.add_widget(self.template_input)
         self.load_template(self.associate_template_file)
-        self.scan_iface = "wls1"
+        self.provisioner = associative.Provisioner([])
+        self.provisioner.subscribe(self.ssid_map.provision_event)
         self.config = BoxLayout(orientation="vertical")
-        # scan for aps in a thread so it does not block ui
-        self.scheduled_scan = Clock.schedule_interval(
-            lambda foo: threading.Thread(target=self.scan_aps).start(), int(10)
-        )
         # create_ap process
         # sudo means than a password prompt appears in terminal
         self.config_vars = {}
@@ -430,12 +447,25 @@ class WirelessDetails(BoxLayout):
         self.config_vars["ap_pass"] = "bar_bar_"
         self.config_vars["ap_virtual_iface"] = "ap0"
         self.create_ap()
+        # scanning starts at once and matched ssids are
+        # provisioned with the ap settings, so they are set first
+        self.scanner = None
+        self.update_scan("wls1")
         self.scheduled_check = Clock.schedule_interval(
             lambda foo: self.check_connected(), int(5)
         )
 
     def update_scan(self, iface):
+        # scans run on the scanner thread of iface, which
+        # calls scan_aps with its results every 10 seconds
+        if self.scanner is not None:
+            self.scanner.unsubscribe(self.scan_aps)
+            if self.scan_iface != iface:
+                self.provisioner.remove_interface(self.scan_iface)
         self.scan_iface = iface
+        self.scanner = scanner.scanner(iface, interval=10)
+        self.scanner.subscribe(self.scan_aps)
+        self.provisioner.add_interface(iface)
 
     def update_ap(self, iface, ssid, ssid_pass):
         self.config_vars["ap_wifi_iface"] = iface
@@ -485,9 +515,8 @@ class WirelessDetails(BoxLayout):
             ).split(),
         )
 
-    def scan_aps(self):
-        found = associative.scan(self.scan_iface)
-        self.ssid_map.update_ssids(found)
+    def scan_aps(self, results):
+        self.ssid_map.update_ssids(results)
 
     def load_template(self, file):
         self.associate_template = pathlib.Path(
@@ -529,6 +558,197 @@ class WirelessDetails(BoxLayout):
             print(ex)
 
 
+class MessageRow(Label):
+    def __init__(self, **kwargs):
+        super(MessageRow, self).__init__(**kwargs)
+        self.halign = "left"
+        self.valign = "middle"
+        self.shorten = True
+        self.bind(size=self.setter("text_size"))
+
+
+class MessageView(BoxLayout):
+    # messages held in a fixed capacity MessageBuffer and
+    # shown in a RecycleView, which only lays out the rows
+    # that are visible. Filtering, pausing and rates work
+    # on the buffer, pausing freezes a snapshot of it while
+    # new messages are still buffered
+    def __init__(self, capacity=5000, on_filter=None, *args, **kwargs):
+        super(MessageView, self).__init__(orientation="vertical")
+        self.buffer = message_buffer.MessageBuffer(capacity)
+        self.on_filter = on_filter
+        self.paused = None
+        self.paused_at = 0
+        # buffer.received count of the message of each row
+        self.row_numbers = collections.deque()
+        self.filter_input = TextInput(
+            hint_text="filter: text or channel glob", multiline=False
+        )
+        self.filter_input.bind(text=self.filter_changed)
+        self.pause_button = ToggleButton(text="pause", size_hint_x=None, width=80)
+        self.pause_button.bind(state=self.toggle_pause)
+        controls = BoxLayout(height=30, size_hint_y=None)
+        controls.add_widget(self.filter_input)
+        controls.add_widget(self.pause_button)
+        self.rates = MessageRow(height=30, size_hint_y=None)
+        self.rows = RecycleView()
+        self.rows.viewclass = MessageRow
+        layout = RecycleBoxLayout(
+            default_size=(None, 24),
+            default_size_hint=(1, None),
+            size_hint_y=None,
+            orientation="vertical",
+        )
+        layout.bind(minimum_height=layout.setter("height"))
+        self.rows.add_widget(layout)
+        self.add_widget(controls)
+        self.add_widget(self.rates)
+        self.add_widget(self.rows)
+        self.scheduled_rates = Clock.schedule_interval(
+            lambda dt: self.update_rates(), 1
+        )
+
+    def extend(self, messages):
+        # (channel, text, time received) in arrival order. Rows
+        # of the new messages are appended and rows of messages
+        # dropped from the buffer removed, the rest are kept
+        first = self.buffer.received
+        for channel, text, received in messages:
+            self.buffer.append(channel, text, received)
+        if self.paused is not None:
+            return
+        oldest = self.buffer.received - len(self.buffer)
+        pattern = self.filter_input.text
+        added = []
+        for number, (channel, text, received) in enumerate(messages, first):
+            if number >= oldest and message_buffer.matches(
+                (received, channel, text), pattern
+            ):
+                added.append({"text": text})
+                self.row_numbers.append(number)
+        excess = 0
+        while self.row_numbers and self.row_numbers[0] < oldest:
+            self.row_numbers.popleft()
+            excess += 1
+        if excess:
+            del self.rows.data[:excess]
+        if added:
+            self.rows.data.extend(added)
+            # follow the newest message
+            self.rows.scroll_y = 0
+
+    def filter_changed(self, widget, text):
+        if self.on_filter is not None:
+            self.on_filter(text)
+        self.refresh()
+
+    def toggle_pause(self, widget, state):
+        if state == "down":
+            self.paused = self.buffer.snapshot()
+            self.paused_at = self.buffer.received
+        else:
+            self.paused = None
+        self.refresh()
+
+    def refresh(self, *args):
+        # rebuild every row, when the filter or pause changes
+        if self.paused is not None:
+            messages = self.paused
+            first = self.paused_at - len(messages)
+        else:
+            messages = self.buffer.messages
+            first = self.buffer.received - len(messages)
+        pattern = self.filter_input.text
+        data = []
+        self.row_numbers = collections.deque()
+        for number, message in enumerate(messages, first):
+            if message_buffer.matches(message, pattern):
+                data.append({"text": message[2]})
+                self.row_numbers.append(number)
+        self.rows.data = data
+        if self.paused is None:
+            # follow the newest message
+            self.rows.scroll_y = 0
+
+    def update_rates(self, shown=5):
+        rates = self.buffer.rates()
+        summary = "  ".join(
+            "{} {:.1f}/s".format(channel, rate) for channel, rate in rates[:shown]
+        )
+        if len(rates) > shown:
+            summary += "  +{} channels".format(len(rates) - shown)
+        if self.paused is not None:
+            summary = "paused, {} new  {}".format(
+                self.buffer.received - self.paused_at, summary
+            )
+        self.rates.text = summary
+
+
+class DbListener(object):
+    # pattern subscriptions read by a thread that blocks on
+    # the pubsub connection until a message arrives, instead
+    # of polling it. Subscriptions are only changed by that
+    # thread, watch() publishes to a channel of its own to
+    # wake it up and apply the new patterns
+    def __init__(self, conn, handler, patterns=("*",), timeout=30):
+        self.conn = conn
+        self.handler = handler
+        self.timeout = timeout
+        self.wake_channel = "machinic:tangle-ui:wake:{}".format(uuid.uuid4())
+        self.lock = threading.Lock()
+        self.wanted = set(patterns)
+        self.subscribed = set()
+        self.stopped = False
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.wake_channel)
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def watch(self, patterns):
+        with self.lock:
+            self.wanted = set(patterns)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.conn.publish(self.wake_channel, "")
+        except Exception as ex:
+            print(ex)
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+
+    def apply(self):
+        with self.lock:
+            wanted = set(self.wanted)
+        subscribe = wanted - self.subscribed
+        unsubscribe = self.subscribed - wanted
+        if subscribe:
+            self.pubsub.psubscribe(*subscribe)
+        if unsubscribe:
+            self.pubsub.punsubscribe(*unsubscribe)
+        self.subscribed = wanted
+
+    def listen(self):
+        while not self.stopped:
+            try:
+                self.apply()
+                message = self.pubsub.get_message(timeout=self.timeout)
+                if message is not None and message["channel"] != self.wake_channel:
+                    self.handler(message)
+            except Exception as ex:
+                print(ex)
+                time.sleep(1)
+                try:
+                    # resubscribe after a dropped connection
+                    self.subscribed = set()
+                    self.pubsub.subscribe(self.wake_channel)
+                except Exception:
+                    pass
+        self.pubsub.close()
+
+
 class TangleApp(App):
     def __init__(self, *args, **kwargs):
         # store kwargs to passthrough
@@ -544,6 +764,17 @@ class TangleApp(App):
             binary_r = redis.StrictRedis(**db_settings)
             redis_conn = redis.StrictRedis(**db_settings, decode_responses=True)
 
+        self.view_capacity = kwargs.get("view_capacity") or 5000
+        self.view_fps = kwargs.get("view_fps") or 30
+        self.db_channels = kwargs.get("db_channels") or ["*"]
+        # (view, channel, text, time received) appended by the
+        # mqtt and db threads and drained on the kivy thread,
+        # deque appends and pops are atomic so no lock is taken.
+        # Bounded by what the views can hold, if the kivy
+        # thread stalls the oldest are dropped as the views
+        # would drop them
+        self.view_messages = collections.deque(maxlen=2 * self.view_capacity)
+
         self.db_port = redis_conn.connection_pool.connection_kwargs["port"]
         self.db_host = redis_conn.connection_pool.connection_kwargs["host"]
 
@@ -551,12 +782,8 @@ class TangleApp(App):
 
     def build(self):
         root = BoxLayout()
-        self.db_event_subscription = redis_conn.pubsub()
-        # subscribe to everything
-        self.db_event_subscription.psubscribe(**{"*": self.handle_db_events})
-        # add thread to pubsub object to stop() on exit
-        self.db_event_subscription.thread = self.db_event_subscription.run_in_thread(
-            sleep_time=0.001
+        self.db_listener = DbListener(
+            redis_conn, self.handle_db_events, self.db_channels
         )
         input_container = BoxLayout(orientation="vertical")
         input_container.add_widget(PathlingWidget(app=self))
@@ -567,13 +794,18 @@ class TangleApp(App):
         view_container = BoxLayout(orientation="vertical")
         root.add_widget(view_container)
         self.views = {}
-        self.views["redis"] = TextInput()
-        self.views["mqtt"] = TextInput()
+        self.views["redis"] = MessageView(
+            self.view_capacity, on_filter=self.scope_db_view
+        )
+        self.views["mqtt"] = MessageView(self.view_capacity)
         for view_name, view in self.views.items():
             view_container.add_widget(
                 Label(text=view_name, height=30, size_hint_y=None)
             )
             view_container.add_widget(view)
+        self.scheduled_views = Clock.schedule_interval(
+            lambda dt: self.drain_views(), 1 / self.view_fps
+        )
         self.broker_service = BrokerService(
             app=self, allow_shell_calls=self.allow_shell_calls
         )
@@ -583,14 +815,15 @@ class TangleApp(App):
     def on_mqtt_message(self, client, userdata, message):
         # print("{} {}".format(message.topic, message.payload.decode()))
         try:
-            Clock.schedule_once(
-                lambda dt: self.update_view(
+            self.view_messages.append(
+                (
                     "mqtt",
+                    message.topic,
                     "topic: {} contents: {}".format(
                         message.topic, message.payload.decode()
                     ),
-                ),
-                .01,
+                    time.time(),
+                )
             )
         except Exception as ex:
             print(ex)
@@ -614,12 +847,30 @@ class TangleApp(App):
             msg = {}
             msg["channel"] = message["channel"]
             msg["data"] = message["data"]
-            Clock.schedule_once(lambda dt: self.update_view("redis", msg), .01)
+            self.view_messages.append(("redis", msg["channel"], str(msg), time.time()))
         except Exception as ex:
             print(ex)
 
-    def update_view(self, view, message):
-        self.views[view].text += str(message) + "\n"
+    def scope_db_view(self, pattern):
+        # a glob filtering the redis view is also what is
+        # subscribed to, otherwise the --db-channels patterns
+        if message_buffer.is_glob(pattern):
+            self.db_listener.watch([pattern])
+        else:
+            self.db_listener.watch(self.db_channels)
+
+    def drain_views(self):
+        # called at most view_fps times a second with the
+        # messages queued since the last call, each view is
+        # updated once for all of its messages. Only what was
+        # queued when the drain started is taken, so a busy
+        # stream cannot hold the kivy thread
+        batches = {}
+        for _ in range(len(self.view_messages)):
+            view, channel, text, received = self.view_messages.popleft()
+            batches.setdefault(view, []).append((channel, text, received))
+        for view, messages in batches.items():
+            self.views[view].extend(messages)
 
     def stop_process(self, name=None):
         if name is None:
@@ -635,11 +886,11 @@ class TangleApp(App):
 
     def on_stop(self):
         # stop pubsub thread if window closed with '[x]'
-        self.db_event_subscription.thread.stop()
+        self.db_listener.stop()
         self.stop_process()
 
     def app_exit(self):
-        self.db_event_subscription.thread.stop()
+        self.db_listener.stop()
         self.stop_process()
         App.get_running_app().stop()
 
@@ -655,6 +906,25 @@ def main():
     parser.add_argument(
         "--allow-shell-calls", action="store_true", help="allow shell calls in routing"
     )
+    parser.add_argument(
+        "--view-capacity",
+        type=int,
+        default=5000,
+        help="messages kept in each of the redis and mqtt views",
+    )
+    parser.add_argument(
+        "--view-fps",
+        type=int,
+        default=30,
+        help="most updates a second of the redis and mqtt views",
+    )
+    parser.add_argument(
+        "--db-channels",
+        nargs="+",
+        default=["*"],
+        help="channel patterns the redis view subscribes to, a glob typed"
+        " in its filter replaces them while it is there",
+    )
     args = parser.parse_args()
 
     if bool(args.db_host) != bool(args.db_port):
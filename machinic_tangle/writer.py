@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import logging
+import time
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBatcher(object):
+    # collects db writes from routed messages and writes
+    # them in a single pipeline once flush_size operations
+    # are waiting or flush_latency seconds have passed since
+    # the first one arrived
+    #
+    # repeated sets of the same key or hash field within a
+    # batch are merged, only the last value is written
+    #
+    # with a journal, batches that fail are journaled and
+    # replayed in order once the db answers again. Until
+    # then new batches are journaled behind them so a
+    # replayed write never overwrites a newer one
+    def __init__(
+        self,
+        redis_conn,
+        flush_size=256,
+        flush_latency=0.002,
+        metrics=None,
+        journal=None,
+        replay_interval=1,
+    ):
+        self.redis_conn = redis_conn
+        self.metrics = metrics
+        self.journal = journal
+        self.replay_interval = replay_interval
+        # held while writing so replays and new batches
+        # reach the db in order
+        self.write_lock = threading.Lock()
+        self.flush_size = max(1, flush_size)
+        self.flush_latency = flush_latency
+        self.condition = threading.Condition()
+        # (kind, key, field, value) tuples, None where a
+        # set was superseded by a later one
+        self.ops = []
+        # (key, field) : index in ops of the latest set
+        self.latest = {}
+        self.first_op = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        if self.journal is not None:
+            self.replay_thread = threading.Thread(target=self.replay_loop, daemon=True)
+            self.replay_thread.start()
+
+    def publish(self, channel, message):
+        self.add(("publish", channel, None, message))
+
+    def set(self, key, value):
+        self.add(("set", key, None, value), (key, None))
+
+    def hset(self, name, field, value):
+        self.add(("hash", name, field, value), (name, field))
+
+    def add(self, op, merge_key=None):
+        with self.condition:
+            if merge_key is not None:
+                previous = self.latest.get(merge_key)
+                if previous is not None:
+                    self.ops[previous] = None
+                    if self.metrics is not None:
+                        self.metrics.count("writes_merged")
+                self.latest[merge_key] = len(self.ops)
+            self.ops.append(op)
+            if len(self.ops) == 1:
+                self.first_op = time.monotonic()
+                self.condition.notify()
+            elif len(self.ops) >= self.flush_size:
+                self.condition.notify()
+
+    def take(self):
+        ops = self.ops
+        self.ops = []
+        self.latest = {}
+        return ops
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.ops:
+                    self.condition.wait()
+                deadline = self.first_op + self.flush_latency
+                while len(self.ops) < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                ops = self.take()
+            self.write(ops)
+
+    def flush(self):
+        # write anything waiting from the calling thread
+        with self.condition:
+            ops = self.take()
+        self.write(ops)
+
+    def write(self, ops):
+        with self.write_lock:
+            if self.journal is not None and self.journal.pending:
+                self.journal.failed(ops)
+                return
+            pipe = self.redis_conn.pipeline(transaction=False)
+            queue_ops(pipe, ops)
+            written = len(pipe)
+            started = time.perf_counter()
+            try:
+                pipe.execute()
+            except Exception as ex:
+                logger.warning("db write failed: %s", ex)
+                if self.metrics is not None:
+                    self.metrics.count("write_errors")
+                if self.journal is not None:
+                    self.journal.failed(ops)
+                written = 0
+            if self.metrics is not None:
+                self.metrics.observe("redis_write", time.perf_counter() - started)
+                self.metrics.count("writes", value=written)
+
+    def replay(self):
+        # write journaled failures oldest first, stopping
+        # at the first that fails again
+        with self.write_lock:
+            for record_id, ops in self.journal.pending_writes():
+                pipe = self.redis_conn.pipeline(transaction=False)
+                queue_ops(pipe, ops)
+                pipe.execute()
+                self.journal.replayed([record_id])
+                if self.metrics is not None:
+                    self.metrics.count("writes_replayed", value=len(ops))
+
+    def replay_loop(self):
+        while True:
+            time.sleep(self.replay_interval)
+            if not self.journal.pending:
+                continue
+            try:
+                self.redis_conn.ping()
+                self.replay()
+            except Exception as ex:
+                logger.debug("db writes not replayed yet: %s", ex)
+
+
+def merge_sets(ops):
+    # ops with every set of a key or hash field but the
+    # last replaced by None, and how many were replaced
+    ops = list(ops)
+    latest = {}
+    merged = 0
+    for index, op in enumerate(ops):
+        kind, key, field, _ = op
+        if kind not in ("set", "hash"):
+            continue
+        previous = latest.get((key, field))
+        if previous is not None:
+            ops[previous] = None
+            merged += 1
+        latest[(key, field)] = index
+    return ops, merged
+
+
+def queue_ops(pipe, ops):
+    # add (kind, key, field, value) write ops to a pipeline
+    for op in ops:
+        if op is None:
+            continue
+        kind, key, field, value = op
+        if kind == "publish":
+            pipe.publish(key, value)
+        elif kind == "set":
+            pipe.set(key, value)
+        elif kind == "hash":
+            pipe.hmset(key, {field: value})
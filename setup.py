@@ -22,6 +22,7 @@ setup(
         "textx",
         "pre-commit",
     ],
+    extras_require={"test": ["pytest", "fakeredis"]},
     dependency_links=[
         "https://github.com/galencm/ma-cli/tarball/master#egg=ma_cli-0.1",
         "https://github.com/galencm/machinic-keli/tarball/master#egg=keli-0.1",
@@ -34,7 +35,9 @@ setup(
             "tangle-associative = machinic_tangle.associative:main",
             "tangle-things = machinic_tangle.tangle_things:main",
             "tangle-bridge = machinic_tangle.bridge_cli:main",
+            "tangle-bridge-bench = machinic_tangle.bridge_bench:main",
             "lings-path-add = machinic_tangle.paths_add:main",
+            "lings-path-validate = machinic_tangle.pathling_validate_spec:main",
         ]
     },
 )
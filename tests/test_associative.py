@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import threading
+import pytest
+
+pytest.importorskip("netifaces")
+pytest.importorskip("jinja2")
+associative = pytest.importorskip("machinic_tangle.associative")
+
+
+def test_provision_retries_then_fails():
+    attempts = []
+    done = threading.Event()
+
+    def provision(iface, ssid, payload):
+        attempts.append((iface, ssid))
+        raise OSError("no device")
+
+    provisioner = associative.Provisioner(
+        ["wlan0"], provision=provision, retries=2, backoff=0
+    )
+    provisioner.subscribe(lambda event: event["event"] == "failed" and done.set())
+    assert provisioner.offer("device-1", {})
+    assert not provisioner.offer("device-1", {})
+    assert done.wait(5)
+    assert attempts == [("wlan0", "device-1")] * 3
+    assert provisioner.status()["failed"] == 1
+    provisioner.stop()
+    provisioner.join()
+
+
+def test_removed_interface_stops_taking():
+    used = []
+    provisioned = threading.Event()
+
+    def provision(iface, ssid, payload):
+        used.append(iface)
+        provisioned.set()
+
+    provisioner = associative.Provisioner(["wlan0"], provision=provision)
+    removed = provisioner.workers["wlan0"]
+    provisioner.remove_interface("wlan0")
+    removed.join(5)
+    assert not removed.is_alive()
+    provisioner.add_interface("wlan1")
+    provisioner.offer("device-1", {})
+    assert provisioned.wait(5)
+    assert used == ["wlan1"]
+    provisioner.stop()
+    provisioner.join()
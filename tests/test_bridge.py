@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pytest
+from machinic_tangle import bridge
+from machinic_tangle import bridge_bench
+from machinic_tangle import bridge_cli
+from machinic_tangle import intake
+from machinic_tangle import routes
+from machinic_tangle import writer
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class FakeBridge(bridge.Bridge):
+    # routes loaded directly, db writes go to fakeredis
+    # and mqtt publishes to a counting fake
+    def __init__(self, route_list, **kwargs):
+        self.test_routes = {routes.route_hash(route): route for route in route_list}
+        kwargs.setdefault("metrics_interval", 0)
+        kwargs.setdefault("route_cache", False)
+        super(FakeBridge, self).__init__("test", 0, "test", 0, **kwargs)
+
+    def start(self):
+        self.redis_conn = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.intake = intake.IntakeQueue()
+        self.writer = writer.WriteBatcher(self.redis_conn, flush_latency=0)
+        self.broker_client = bridge_bench.FakeMqtt()
+        self.routes.sync(self.test_routes)
+
+
+def test_keyspace_set_is_routed_with_value():
+    routing = FakeBridge(["bar -> /baz"])
+    routing.redis_conn.set("bar", "hello")
+    routing.db_message(routing.keyspace_prefix + "bar", "set")
+    assert routing.intake.get() == ("bar", "hello", True)
+
+
+def test_other_keyspace_events_are_not_routed():
+    routing = FakeBridge(["bar -> /baz"])
+    for event in ("hset", "del", "expired"):
+        routing.db_message(routing.keyspace_prefix + "bar", event)
+    assert len(routing.intake) == 0
+
+
+def test_hash_writes_do_not_loop():
+    routing = FakeBridge(['/x >> "bar"::"f"', "bar -> /x"])
+    routing.routing("/x", "hello")
+    routing.writer.flush()
+    assert routing.redis_conn.hget("bar", "f") == "hello"
+    # the keyspace event of the hset
+    routing.db_message(routing.keyspace_prefix + "bar", "hset")
+    assert len(routing.intake) == 0
+    assert routing.broker_client.published == 0
+
+
+def test_db_channel_message_is_routed():
+    routing = FakeBridge(["bar -> /baz"])
+    routing.db_message("bar", "hello")
+    channel, message, db = routing.intake.get()
+    routing.routing(channel, message, db=db)
+    assert routing.broker_client.published == 1
+
+
+def test_only_one_worker_subscribes_to_db():
+    route_list = ["bar -> /baz", "/foo -> bar"]
+    first = FakeBridge(route_list, shard=(0, 3), route_db=True)
+    others = [FakeBridge(route_list, shard=(i, 3), route_db=False) for i in (1, 2)]
+    assert first.db_subscriptions()[0] == {"bar", first.keyspace_prefix + "bar"}
+    for other in others:
+        assert other.db_subscriptions() == (set(), set())
+
+
+def test_cycles():
+    route_table = FakeBridge(
+        ["/a -> /b", "/b -> /a", "/c -> /d", "/e -> f", "f -> /e", "/g -> /g"]
+    ).routes
+    looping = sorted(route.route for route in route_table.cycles())
+    assert looping == ["/a -> /b", "/b -> /a", "/e -> f", "/g -> /g", "f -> /e"]
+
+
+class ConnectingMqtt(bridge_bench.FakeMqtt):
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        raise AssertionError("replay subscribed to {}".format(topic))
+
+
+def test_replay_bridge_only_sends(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        bridge.redis,
+        "StrictRedis",
+        lambda **kwargs: fakeredis.FakeStrictRedis(server=server, **kwargs),
+    )
+    monkeypatch.setattr(bridge_cli.mosquitto, "Client", ConnectingMqtt)
+    db = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    db.hset("machinic:routes:test:0", routes.route_hash("/foo >> bar"), "/foo >> bar")
+    replaying = bridge_cli.ReplayBridge(
+        "test", 0, "test", 0, metrics_interval=0, route_cache=False
+    )
+    assert not hasattr(replaying, "intake")
+    assert not hasattr(replaying, "routes_subscription")
+    replaying.routing("/foo", "hello")
+    replaying.writer.flush()
+    assert db.get("bar") == "hello"
+
+
+def test_removed_routes_are_forgotten_by_metrics():
+    routing = FakeBridge(["/foo -> /bar", "/baz -> /bar"])
+    routing.routing("/foo", "hello")
+    routing.routing("/baz", "hello")
+    kept = routes.route_hash("/foo -> /bar")
+    routing.routes.sync({kept: "/foo -> /bar"})
+    routing.routes_changed()
+    assert list(routing.metrics.counters["route_hits"]) == [kept]
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import asyncio
+import pytest
+from machinic_tangle import bridge_bench
+from machinic_tangle import routes
+
+fakeredis = pytest.importorskip("fakeredis")
+# requires redis.asyncio
+bridge_async = pytest.importorskip("machinic_tangle.bridge_async")
+
+
+class FakeAsyncBridge(bridge_async.AsyncBridge):
+    # the queues of main() without the broker or the
+    # route subscription, db writes go to fakeredis
+    def __init__(self, route_list, **kwargs):
+        self.test_routes = {routes.route_hash(route): route for route in route_list}
+        kwargs.setdefault("metrics_interval", 0)
+        kwargs.setdefault("route_cache", False)
+        super(FakeAsyncBridge, self).__init__("test", 0, "test", 0, **kwargs)
+        self.routes.sync(self.test_routes)
+        self.broker_client = bridge_bench.FakeMqtt()
+
+    async def prepare(self):
+        self.loop = asyncio.get_running_loop()
+        self.db = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        self.intake = asyncio.Queue(maxsize=self.queue_size)
+        self.waiting_puts = set()
+        self.output = asyncio.Queue(maxsize=self.queue_size)
+        self.reading = True
+        self.write_lock = asyncio.Lock()
+
+
+def test_failed_message_does_not_stop_routing():
+    async def run():
+        routing = FakeAsyncBridge(["/foo -> /bar"])
+        await routing.prepare()
+        task = asyncio.ensure_future(routing.route_messages())
+        await routing.intake.put(("/foo", b"\xff\xfe", False))
+        await routing.intake.put(("/foo", b"hello", False))
+        while not routing.intake.empty():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        task.cancel()
+        return routing
+
+    routing = asyncio.run(run())
+    assert routing.broker_client.published == 1
+
+
+def test_outputs_are_batched_and_merged():
+    async def run():
+        routing = FakeAsyncBridge(
+            ["/foo >> bar", '/foo >> "baz"::"f"'], flush_latency=0.05
+        )
+        await routing.prepare()
+        tasks = [
+            asyncio.ensure_future(routing.route_messages()),
+            asyncio.ensure_future(routing.write_outputs()),
+        ]
+        for n in range(3):
+            await routing.intake.put(("/foo", str(n), False))
+        await asyncio.sleep(0.2)
+        for task in tasks:
+            task.cancel()
+        values = (await routing.db.get("bar"), await routing.db.hget("baz", "f"))
+        return routing, values
+
+    routing, values = asyncio.run(run())
+    assert values == ("2", "2")
+    # one batch with the first two sets of each merged away
+    assert routing.metrics.counters["writes_merged"][""] == 4
+    assert routing.metrics.counters["writes"][""] == 2
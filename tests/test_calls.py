@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import collections
+import threading
+import time
+from machinic_tangle import calls
+
+Route = collections.namedtuple("Route", "route_hash kind")
+
+
+class HeldPool(calls.CallPool):
+    # calls wait for release instead of running a process,
+    # recording the most calls of a route running at once
+    def __init__(self, **kwargs):
+        self.release_calls = threading.Event()
+        self.record = threading.Lock()
+        self.started = []
+        self.now = collections.Counter()
+        self.most = collections.Counter()
+        super(HeldPool, self).__init__(**kwargs)
+
+    def run(self, call):
+        route_hash = call[0]
+        with self.record:
+            self.started.append(call)
+            self.now[route_hash] += 1
+            self.most[route_hash] = max(self.most[route_hash], self.now[route_hash])
+        self.release_calls.wait(5)
+        with self.record:
+            self.now[route_hash] -= 1
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_route_limit():
+    pool = HeldPool(workers=4, route_limit=2)
+    nonblocking = Route("n", "nonblocking")
+    blocking = Route("b", "blocking")
+    for n in range(4):
+        pool.submit(nonblocking, ["n", n])
+        pool.submit(blocking, ["b", n])
+    assert wait_for(lambda: len(pool.started) == 3)
+    time.sleep(0.05)
+    assert len(pool.started) == 3
+    pool.release_calls.set()
+    assert wait_for(lambda: len(pool.started) == 8)
+    assert pool.most == {"n": 2, "b": 1}
+    # blocking calls run in order
+    assert [call[1] for call in pool.started if call[0] == "b"] == [0, 1, 2, 3]
+
+
+def test_drop_when_queue_is_full():
+    pool = HeldPool(workers=1, route_limit=1, queue_depth=2)
+    route = Route("n", "nonblocking")
+    assert pool.submit(route, ["n", 0])
+    assert wait_for(lambda: len(pool.started) == 1)
+    assert pool.submit(route, ["n", 1])
+    assert pool.submit(route, ["n", 2])
+    assert not pool.submit(route, ["n", 3])
+    assert pool.dropped == 1
+    assert pool.queued() == 2
+    pool.release_calls.set()
+    assert wait_for(lambda: pool.queued() == 0 and len(pool.started) == 3)
+    assert [call[1] for call in pool.started] == [0, 1, 2]
+
+
+def test_coalesce_drops_oldest_waiting():
+    pool = HeldPool(workers=1, route_limit=1, queue_depth=2, overflow="coalesce")
+    route = Route("n", "nonblocking")
+    pool.submit(route, ["n", 0])
+    assert wait_for(lambda: len(pool.started) == 1)
+    for n in range(1, 5):
+        assert pool.submit(route, ["n", n])
+    assert pool.coalesced == 2
+    pool.release_calls.set()
+    assert wait_for(lambda: len(pool.started) == 3)
+    assert [call[1] for call in pool.started] == [0, 3, 4]
+
+
+def test_timeouts_are_counted():
+    pool = calls.CallPool(workers=1, timeout=0.1)
+    started = time.monotonic()
+    pool.run(["sleep", "5"])
+    assert time.monotonic() - started < 4
+    assert pool.timeouts == 1
+    pool.run(["true"])
+    assert pool.timeouts == 1
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import threading
+import pytest
+from machinic_tangle import intake
+
+
+def drain(queue):
+    return [queue.get() for _ in range(len(queue))]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        intake.IntakeQueue(overflow="newest")
+
+
+def test_block_waits_for_room():
+    queue = intake.IntakeQueue(size=2)
+    queue.put("/a", "1")
+    queue.put("/a", "2")
+    put = threading.Thread(target=queue.put, args=("/a", "3"))
+    put.start()
+    put.join(0.1)
+    assert put.is_alive()
+    assert queue.get() == ("/a", "1", False)
+    put.join(5)
+    assert not put.is_alive()
+    assert drain(queue) == [("/a", "2", False), ("/a", "3", False)]
+    assert queue.dropped == 0
+
+
+def test_drop_oldest():
+    queue = intake.IntakeQueue(size=2, overflow="drop-oldest")
+    for n in range(5):
+        queue.put("/a", str(n))
+    assert len(queue) == 2
+    assert queue.dropped == 3
+    assert drain(queue) == [("/a", "3", False), ("/a", "4", False)]
+
+
+def test_coalesce_keeps_latest_per_channel():
+    queue = intake.IntakeQueue(size=2, overflow="coalesce")
+    queue.put("/a", "1")
+    queue.put("/b", "1")
+    queue.put("/a", "2")
+    # same channel from the db is a different source
+    queue.put("/a", "3", True)
+    assert queue.coalesced == 1
+    assert queue.dropped == 1
+    assert drain(queue) == [("/b", "1", False), ("/a", "3", True)]
+
+
+def test_coalesce_keeps_place():
+    queue = intake.IntakeQueue(size=3, overflow="coalesce")
+    queue.put("/a", "1")
+    queue.put("/b", "1")
+    queue.put("/a", "2")
+    assert queue.dropped == 0
+    assert drain(queue) == [("/a", "2", False), ("/b", "1", False)]
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pytest
+from machinic_tangle import journal
+from machinic_tangle import writer
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def test_pending_recovered_after_restart(tmp_path):
+    first = journal.Journal(tmp_path, segment_size=4096)
+    replayed = first.failed([("set", "a", None, "1")])
+    kept = first.failed([("hash", "b", "f", "2"), None])
+    first.message("mqtt", "/foo", "hello", [])
+    first.replayed([replayed])
+    first.sync()
+    restarted = journal.Journal(tmp_path, segment_size=4096)
+    assert restarted.pending_writes() == [(kept, [("hash", "b", "f", "2")])]
+    # ids keep increasing across restarts
+    assert restarted.next_id == kept + 2
+
+
+def test_rotation_keeps_pending(tmp_path):
+    rotating = journal.Journal(tmp_path, segment_size=512, max_segments=2)
+    kept = rotating.failed([("set", "a", None, "1")])
+    for n in range(100):
+        rotating.message("mqtt", "/foo", str(n), [])
+    rotating.sync()
+    assert len(rotating.segments()) <= 2
+    restarted = journal.Journal(tmp_path, segment_size=512, max_segments=2)
+    assert restarted.pending_writes() == [(kept, [("set", "a", None, "1")])]
+
+
+def damage(tmp_path, change):
+    damaged = journal.Journal(tmp_path, segment_size=4096)
+    for n in range(3):
+        damaged.message("mqtt", "/foo", str(n), [])
+    damaged.sync()
+    path = damaged.segments()[-1]
+    data = bytearray(path.read_bytes())
+    # start of the second record
+    second = journal.header.size + journal.header.unpack_from(data, 0)[0]
+    path.write_bytes(change(data, second))
+    return list(journal.messages(tmp_path))
+
+
+def test_crc_damaged_record_ends_reading(tmp_path):
+    def flip(data, second):
+        data[second + journal.header.size + 2] ^= 0xFF
+        return bytes(data)
+
+    assert damage(tmp_path, flip) == [("mqtt", "/foo", "0")]
+
+
+def test_torn_record_ends_reading(tmp_path):
+    def tear(data, second):
+        return bytes(data[: second + journal.header.size + 2])
+
+    assert damage(tmp_path, tear) == [("mqtt", "/foo", "0")]
+
+
+def test_writes_wait_behind_pending_and_replay_in_order(tmp_path):
+    server = fakeredis.FakeServer()
+    db = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    batcher = writer.WriteBatcher(
+        db,
+        flush_latency=60,
+        journal=journal.Journal(tmp_path, segment_size=4096),
+        replay_interval=3600,
+    )
+    server.connected = False
+    batcher.set("a", "1")
+    batcher.flush()
+    assert len(batcher.journal.pending) == 1
+    server.connected = True
+    batcher.set("a", "2")
+    batcher.publish("/foo", "x")
+    batcher.flush()
+    # journaled behind the failed write instead of written
+    assert db.get("a") is None
+    assert len(batcher.journal.pending) == 2
+    batcher.replay()
+    assert db.get("a") == "2"
+    assert not batcher.journal.pending
@@ -0,0 +1,29 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+from machinic_tangle import message_buffer
+
+
+def test_capacity_and_rates():
+    buffer = message_buffer.MessageBuffer(capacity=3, rate_window=2)
+    for n in range(5):
+        buffer.append("/foo", str(n), now=100)
+    buffer.append("bar", "x", now=101)
+    assert len(buffer) == 3
+    assert buffer.received == 6
+    assert [text for _, _, text in buffer.snapshot()] == ["3", "4", "x"]
+    assert buffer.rates(now=101) == [("/foo", 2.5), ("bar", 0.5)]
+    assert buffer.rates(now=103) == []
+
+
+def test_matches():
+    message = (0, "/foo/bar", "hello")
+    assert message_buffer.matches(message, "")
+    assert message_buffer.matches(message, "ell")
+    assert message_buffer.matches(message, "foo")
+    assert message_buffer.matches(message, "/foo/*")
+    assert not message_buffer.matches(message, "hel*")
+    assert not message_buffer.matches(message, "baz")
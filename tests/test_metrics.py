@@ -0,0 +1,35 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+from machinic_tangle import metrics
+from machinic_tangle import pathling
+
+
+def test_snapshot():
+    collected = metrics.Metrics()
+    collected.count("writes", value=3)
+    collected.count("calls", label="dropped")
+    collected.observe("redis_write", 0.001)
+    collected.gauge("queued", lambda: 7)
+    collected.gauge("broken", lambda: 1 / 0)
+    snapshot = collected.snapshot()
+    assert snapshot["writes"] == 3
+    assert snapshot["calls:dropped"] == 1
+    assert snapshot["redis_write:count"] == 1
+    assert snapshot["queued"] == 7
+    assert "broken" not in snapshot
+
+
+def test_forget_routes():
+    collected = metrics.Metrics()
+    kept = pathling.validate("/foo -> bar", cache=False)
+    removed = pathling.validate("/baz -> bar", cache=False)
+    for route in (kept, removed, removed):
+        collected.route_hit(route)
+    collected.forget_routes([kept.route_hash])
+    assert dict(collected.counters["route_hits"]) == {kept.route_hash: 1}
+    assert collected.route_names == {kept.route_hash: kept.route}
+    assert removed.route not in collected.prometheus()
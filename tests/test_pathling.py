@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pytest
+from machinic_tangle import pathling
+from machinic_tangle import pathling_validate_spec as validate_spec
+from machinic_tangle import routes
+
+
+def test_cache_path_has_grammar_and_compiled_version(tmp_path, monkeypatch):
+    monkeypatch.setenv("MACHINIC_TANGLE_CACHE", str(tmp_path))
+    cache = pathling.RouteCache()
+    assert cache.path.parent == tmp_path
+    assert cache.path.name == "pathling-{}-{}.json".format(
+        pathling.grammar_hash()[:16], routes.compiled_version
+    )
+
+
+def test_cache_round_trip(tmp_path):
+    path = tmp_path / "cache.json"
+    route = '(/foo > 1) ["$message"] -- $(echo $message)'
+    compiled = pathling.validate(route, pathling.RouteCache(path))
+    assert path.exists()
+    cache = pathling.RouteCache(path)
+    assert cache.get(compiled.route_hash, route) == compiled
+    # entries are only used for the route they were made from
+    assert cache.get(compiled.route_hash, "/foo -> bar") is None
+
+
+def test_cache_saves_routes_that_send_nothing(tmp_path):
+    path = tmp_path / "cache.json"
+    cache = pathling.RouteCache(path)
+    for route in ["/foo -> $(echo )", '/foo -- "a"::"b"', "/foo -> bar"]:
+        pathling.validate(route, cache)
+    assert len(pathling.RouteCache(path).read()) == 3
+
+
+def spec_routes():
+    return [
+        route
+        for _, _, route in validate_spec.read_routes([str(validate_spec.spec_file)])
+    ]
+
+
+def test_spec_routes_parse_as_textx_does():
+    routes = spec_routes()
+    assert routes
+    for route in routes:
+        reference = validate_spec.reference_dump(route)
+        assert reference is not None, route
+        assert pathling.dump(pathling.Parser(route).parse()) == reference, route
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_fuzzed_routes_parse_as_textx_does(seed):
+    given = list(validate_spec.read_routes([str(validate_spec.spec_file)]))
+    for _, _, route in validate_spec.fuzz_routes(given, 500, seed):
+        result = validate_spec.validate(("fuzz", 0, route, True))
+        assert "differs" not in result, result
+
+
+def test_validate_rejects_what_the_bridge_rejects():
+    for route in ['"a"::"b" -> c', "$(echo )->c"]:
+        result = validate_spec.validate(("test", 1, route, False))
+        assert not result["valid"]
+        assert "route source" in result["error"]
+    assert validate_spec.validate(("test", 1, "/foo -> bar", False))["valid"]
@@ -0,0 +1,34 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pytest
+from machinic_tangle import paths_add
+from machinic_tangle import pathling
+
+
+def test_check_accepts_what_validate_accepts():
+    route_list = ["/foo -> bar", '"a"::"b" -> c', "$(echo )->c", "/foo ->"]
+    errors = paths_add.check_all(route_list, jobs=1)
+    for route, error in zip(route_list, errors):
+        if error is None:
+            pathling.validate(route, cache=False)
+        else:
+            with pytest.raises(Exception):
+                pathling.validate(route, cache=False)
+    assert errors[0] is None
+    assert all(errors[1:])
+
+
+def test_parse_lines():
+    lines = [
+        ("site", 1, "# comment"),
+        ("site", 2, "/foo -> bar"),
+        ("site", 3, ""),
+        ("site", 4, "- /old -> bar"),
+    ]
+    added, removed = paths_add.parse_lines(lines)
+    assert added == [("site", 2, "/foo -> bar")]
+    assert removed == ["/old -> bar"]
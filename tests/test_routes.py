@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pytest
+from machinic_tangle import pathling
+from machinic_tangle import routes
+
+
+def compile_route(route):
+    return routes.compile_route(route, pathling.parse)
+
+
+def table(*route_list):
+    route_table = routes.RouteTable(pathling.parse)
+    route_table.sync({routes.route_hash(route): route for route in route_list})
+    return route_table
+
+
+@pytest.mark.parametrize(
+    "route,kind,destination",
+    [
+        ("/foo -> bar", "publish", "bar"),
+        ("/foo -> /bar", "mqtt", "/bar"),
+        ("/foo >> bar", "set", "bar"),
+        ('/foo >> "bar"::"baz"', "hash", "bar"),
+        ("/foo -- $(echo $message)", "nonblocking", "echo"),
+        ("/foo -- $$(echo $message)", "blocking", "echo"),
+        ("/foo >> $(echo)", None, "$(echo)"),
+    ],
+)
+def test_compile_kinds(route, kind, destination):
+    compiled = compile_route(route)
+    assert compiled.kind == kind
+    if kind is not None:
+        assert compiled.destination == destination
+
+
+def test_compile_expression():
+    compiled = compile_route("(/foo >= 3) -> bar")
+    assert compiled.source == "/foo"
+    assert compiled.expression == (">=", 3)
+
+
+@pytest.mark.parametrize(
+    "route",
+    ['("a"::"b" > 1) -> c', '"a"::"b" -> c', "($(echo )>1)->c", "$(echo )->c"],
+)
+def test_compile_rejects_sources_without_messages(route):
+    # valid grammar, but not something a message arrives on
+    pathling.parse(route)
+    with pytest.raises(ValueError):
+        compile_route(route)
+
+
+def test_table_marks_uncompilable_routes_invalid():
+    route_table = table('("a"::"b" > 1) -> c', "/foo -> bar")
+    assert len(route_table.routes) == 1
+    assert len(route_table.invalid) == 1
+    assert [route.destination for route in route_table.match("/foo")] == ["bar"]
+
+
+def test_render_template():
+    tokens = routes.compile_template("$channel:$message:$HOME:$messageX")
+    env = {"$HOME": "/home"}
+    assert routes.render_template(tokens, "m", "/c", env) == "/c:m:/home:$messageX"
+
+
+@pytest.mark.parametrize(
+    "topic_filter,topic,matched",
+    [
+        ("/foo/+", "/foo/bar", True),
+        ("/foo/+", "/foo/bar/baz", False),
+        ("/foo/#", "/foo", True),
+        ("/foo/#", "/foo/bar/baz", True),
+        ("#", "/foo", True),
+        ("+/+", "/foo", True),
+        ("#", "$SYS/foo", False),
+        ("/foo/bar", "/foo/bar", True),
+    ],
+)
+def test_topic_trie(topic_filter, topic, matched):
+    trie = routes.TopicTrie()
+    trie.add(topic_filter, topic_filter)
+    assert (trie.match(topic) == [topic_filter]) == matched
+
+
+def test_index_matches_exact_and_filters():
+    route_table = table("/foo/+ -> a", "/foo/bar -> b", "(/foo/bar > 1) -> c")
+    matched = sorted(route.destination for route in route_table.match("/foo/bar"))
+    assert matched == ["a", "b", "c"]
+    assert route_table.match("/foo") == ()
+
+
+def test_db_sources():
+    route_table = table("foo -> /bar", "/foo -> bar")
+    assert route_table.db_sources == {"foo"}
+    assert [route.destination for route in route_table.match_db("foo")] == ["/bar"]
+
+
+@pytest.mark.parametrize(
+    "topic_filter,other,covered",
+    [
+        ("/foo/#", "/foo/bar/+", True),
+        ("/foo/+", "/foo/bar", True),
+        ("/foo/+", "/foo/bar/#", False),
+        ("/foo/+", "/foo/#", False),
+        ("/foo/bar", "/foo/+", False),
+    ],
+)
+def test_covers(topic_filter, other, covered):
+    assert routes.covers(topic_filter, other) == covered
+
+
+def test_minimal_filters():
+    assert routes.minimal_filters({"/foo/+", "/foo/bar", "/baz"}) == {
+        "/foo/+",
+        "/baz",
+    }
+    assert routes.minimal_filters({"#", "/foo"}) == {"#"}
+
+
+@pytest.mark.parametrize(
+    "topic_filter,valid",
+    [
+        ("/foo/+", True),
+        ("/foo/#", True),
+        ("#", True),
+        ("+/+/bar", True),
+        ("/foo/#/bar", False),
+        ("/fo#o", False),
+        ("/foo/+x", False),
+    ],
+)
+def test_valid_topic_filter(topic_filter, valid):
+    assert routes.valid_topic_filter(topic_filter) == valid
+
+
+@pytest.mark.parametrize("route", ["/foo/#/bar -> x", "/fo#o -> x", "/foo/+x -> x"])
+def test_invalid_topic_filters_do_not_parse(route):
+    with pytest.raises(Exception):
+        pathling.parse(route)
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import pathlib
+from machinic_tangle import scanner
+
+fixtures = pathlib.Path(__file__).parent / "fixtures"
+
+
+def scan(name, parse):
+    with open(str(fixtures / name), "r") as output:
+        return {seen.bssid: seen for seen in parse(output.read())}
+
+
+def test_parse_iw():
+    found = scan("iw_scan.txt", scanner.parse_iw)
+    assert len(found) == 4
+    assert found["00:11:22:33:44:55"] == scanner.Bss(
+        "00:11:22:33:44:55", "homie-1234", -35.0, 2437, 6, False, None
+    )
+    # \xNN escaped utf-8, channel from the ht primary channel
+    assert found["aa:bb:cc:dd:ee:ff"] == scanner.Bss(
+        "aa:bb:cc:dd:ee:ff", "café ☕", -70.0, 5180, 36, True, None
+    )
+
+
+def test_parse_iw_hidden_and_missing():
+    found = scan("iw_scan.txt", scanner.parse_iw)
+    nuls = found["aa:bb:cc:dd:ee:00"]
+    assert nuls.ssid == ""
+    assert nuls.signal is None
+    # channel derived from the frequency
+    assert nuls.channel == 11
+    empty = found["aa:bb:cc:dd:ee:01"]
+    assert empty.ssid == ""
+    assert empty.signal is None
+    assert empty.frequency is None
+    assert empty.channel is None
+    assert not empty.encrypted
+
+
+def test_parse_iwlist():
+    found = scan("iwlist_scan.txt", scanner.parse_iwlist)
+    assert len(found) == 3
+    assert found["00:11:22:33:44:55"] == scanner.Bss(
+        "00:11:22:33:44:55", "homie-1234", -35.0, 2437, 6, False, None
+    )
+    # escaped quotes, channel derived from the frequency
+    assert found["aa:bb:cc:dd:ee:ff"] == scanner.Bss(
+        "aa:bb:cc:dd:ee:ff", 'café "x"', -70.0, 5180, 36, True, None
+    )
+
+
+def test_parse_iwlist_hidden_and_missing():
+    hidden = scan("iwlist_scan.txt", scanner.parse_iwlist)["aa:bb:cc:dd:ee:00"]
+    assert hidden == scanner.Bss("aa:bb:cc:dd:ee:00", "", None, None, None, True, None)
+
+
+def test_unescape():
+    assert scanner.unescape("plain") == "plain"
+    assert scanner.unescape("a\\x20b") == "a b"
+    # invalid utf-8 is replaced, not raised
+    assert scanner.unescape("\\xff") == "�"
+
+
+def test_frequency_channel():
+    assert scanner.frequency_channel(2412) == 1
+    assert scanner.frequency_channel(2484) == 14
+    assert scanner.frequency_channel(5745) == 149
+    assert scanner.frequency_channel(None) is None
+    assert scanner.frequency_channel(60480) is None
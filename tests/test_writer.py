@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2018, Galen Curwen-McAdams
+
+import time
+import pytest
+from machinic_tangle import metrics
+from machinic_tangle import writer
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_last_set_wins():
+    db = fakeredis.FakeStrictRedis(decode_responses=True)
+    collected = metrics.Metrics()
+    batcher = writer.WriteBatcher(db, flush_latency=60, metrics=collected)
+    for n in range(3):
+        batcher.set("a", str(n))
+        batcher.hset("b", "f", str(n))
+    batcher.hset("b", "g", "other")
+    batcher.flush()
+    assert db.get("a") == "2"
+    assert db.hgetall("b") == {"f": "2", "g": "other"}
+    assert collected.counters["writes_merged"][""] == 4
+    assert collected.counters["writes"][""] == 3
+
+
+def test_merge_sets():
+    ops = [
+        ("set", "a", None, "1"),
+        ("publish", "a", None, "x"),
+        ("hash", "a", "f", "1"),
+        ("set", "a", None, "2"),
+        ("publish", "a", None, "y"),
+    ]
+    merged, count = writer.merge_sets(ops)
+    assert count == 1
+    assert merged == [None] + ops[1:]
+
+
+def test_flush_on_size():
+    db = fakeredis.FakeStrictRedis(decode_responses=True)
+    batcher = writer.WriteBatcher(db, flush_size=3, flush_latency=60)
+    batcher.set("a", "1")
+    batcher.set("b", "1")
+    time.sleep(0.05)
+    assert db.get("a") is None
+    batcher.set("c", "1")
+    assert wait_for(lambda: db.get("c") == "1")
+    assert db.get("a") == "1"
+
+
+def test_flush_on_latency():
+    db = fakeredis.FakeStrictRedis(decode_responses=True)
+    batcher = writer.WriteBatcher(db, flush_size=100, flush_latency=0.05)
+    started = time.monotonic()
+    batcher.set("a", "1")
+    assert wait_for(lambda: db.get("a") == "1")
+    assert time.monotonic() - started >= 0.05
+
+
+def test_failed_writes_are_not_counted():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    db = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    collected = metrics.Metrics()
+    batcher = writer.WriteBatcher(db, flush_latency=60, metrics=collected)
+    batcher.set("a", "1")
+    batcher.flush()
+    assert collected.counters["write_errors"][""] == 1
+    assert collected.counters["writes"][""] == 0